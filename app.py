@@ -1,12 +1,36 @@
 import streamlit as st
-import pandas as pd
 from datetime import datetime, date
-import io
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
+import functools
+import importlib
+import logging
 import os
+import threading
+import time
+
+import metrics
+import questionnaire
+import scoring
+from record import Response, is_submission_key, new_submission_key
+
+log = logging.getLogger(__name__)
+
+# 送出相關模組 (SMTP / MIME / SQLite / 附件) 只在 Step 4 才需要，
+# 一律延後載入，讓 Step 1 不必等待這些 import 就能畫出來。
+SUBMISSION_MODULES = ("mailer", "outbox", "store", "attachments")
+
+# 問卷的冪等鍵也放在網址參數：重新整理或複製分頁後再送出，仍視為同一份問卷
+SUBMISSION_PARAM = "submission"
+
+# 同一台機器執行多個程序時，/metrics 依序改用下一個埠
+METRICS_PORT_TRIES = 16
+
+# Step 2 / 3 的輸入方式 (secrets.toml 的 INPUT_MODE)：
+# live 每個輸入即時更新畫面；batch 整個步驟包成表單，按下一步才送出一次
+INPUT_LIVE = "live"
+INPUT_BATCH = "batch"
+
+# 閒置檢查的間隔 (秒)；逾時長度與 session 上限見 get_sessions()
+IDLE_CHECK_SECONDS = 30
 
 # --- 1. 頁面設定 ---
 st.set_page_config(
@@ -94,8 +118,8 @@ st.markdown("""
         height: 50px;
     }
 
-    /* 按鈕優化 */
-    .stButton > button {
+    /* 按鈕優化 (含批次模式的表單按鈕) */
+    .stButton > button, .stFormSubmitButton > button {
         width: 100%;
         height: 60px;
         font-size: 20px !important;
@@ -141,69 +165,475 @@ st.markdown("""
 
 # --- 3. 核心邏輯函數 ---
 
-def calculate_blood_score(pad_light, pad_medium, pad_heavy,
-                          tampon_light, tampon_medium, tampon_heavy,
-                          small_clot, large_clot, accident):
-    return (pad_light*1 + pad_medium*5 + pad_heavy*20 +
-            tampon_light*1 + tampon_medium*5 + tampon_heavy*10 +
-            small_clot*1 + large_clot*5 + accident*5)
-
-def send_email_via_gmail(subject, content, df, filename):
+@st.cache_resource
+def warm_up_submission_stack():
+    """首頁畫出後，在背景預先載入送出時才用到的模組"""
+    def load():
+        for name in SUBMISSION_MODULES:
+            try:
+                importlib.import_module(name)
+            except Exception:
+                # 預載只是加速，失敗時送出當下仍會正常載入
+                return
+    threading.Thread(target=load, name="warm-up", daemon=True).start()
+
+@st.cache_resource
+def start_metrics():
+    """secrets.toml 設定 METRICS_PORT 時在本機提供 /metrics；METRICS_TRACE_LOG 為追蹤紀錄檔路徑。
+
+    計數只在各程序記憶體內累加，多個程序各自提供一個埠，由 Prometheus 依 instance 加總。
+    """
+    try:
+        port = int(st.secrets.get("METRICS_PORT", 0))
+        trace_log = st.secrets.get("METRICS_TRACE_LOG")
+    except Exception:
+        return None
+    if trace_log:
+        metrics.enable_trace(trace_log)
+    if not port:
+        return None
+    for offset in range(METRICS_PORT_TRIES):
+        try:
+            return metrics.serve(port + offset)
+        except OSError:
+            # 同一台機器上的其他程序已佔用此埠
+            continue
+    return None
+
+@st.cache_resource
+def start_export_api():
+    """secrets.toml 設定 EXPORT_PORT 與 EXPORT_TOKEN 時，在本機提供唯讀匯出 API (export.py)"""
+    try:
+        port = int(st.secrets.get("EXPORT_PORT", 0))
+        token = st.secrets.get("EXPORT_TOKEN")
+    except Exception:
+        return None
+    if not port or not token:
+        return None
+    import export
+    try:
+        return export.serve(get_store(), port, str(token))
+    except OSError:
+        # 同一台機器上的其他程序已提供 (讀的是同一個資料庫)
+        return None
+
+@st.cache_resource
+def get_sessions():
+    """整個程序共用的 session 管理；secrets.toml 可設 SESSION_IDLE_MINUTES、SESSION_MAX、SESSION_MEMORY_MB"""
+    import sessions
+
+    def setting(name, default):
+        try:
+            return float(st.secrets.get(name, default))
+        except Exception:
+            return default
+
+    return sessions.SessionRegistry(
+        idle_timeout=setting("SESSION_IDLE_MINUTES", sessions.DEFAULT_IDLE_TIMEOUT / 60) * 60,
+        max_sessions=int(setting("SESSION_MAX", sessions.DEFAULT_MAX_SESSIONS)),
+        max_bytes=int(setting("SESSION_MEMORY_MB", sessions.DEFAULT_MAX_BYTES / 2**20) * 2**20),
+    )
+
+@st.cache_resource
+def get_outbox():
+    """整個程式共用一個送出暫存區與背景寄送執行緒"""
+    import mailer
+    from outbox import Outbox, DeliveryWorker
+
+    outbox = Outbox(**mailer.load_send_limits())
+    DeliveryWorker(
+        outbox,
+        mailer.deliver,
+        deliver_digest=mailer.deliver_digest,
+        digest_window=mailer.load_digest_minutes() * 60
+    ).start()
+    return outbox
+
+@st.cache_resource
+def start_delivery():
+    """程式一啟動就開始寄送：重啟前留在暫存區的信件不必等到下一位病患送出才寄。
+
+    暫存區或寄送設定有問題 (磁碟、data/ 無法寫入、寄送限制設定錯誤) 時只記錄下來，不影響 Step 1-3；
+    送出時 get_outbox() 會再建立一次，錯誤顯示在 Step 4。
+    """
+    try:
+        return get_outbox()
+    except Exception:
+        log.exception("無法啟動背景寄送，等到送出時再試")
+        metrics.count("delivery_start_failures_total")
+        return None
+
+@st.cache_resource
+def get_store():
+    from store import ResponseStore
+    return ResponseStore()
+
+@st.cache_resource
+def get_patient_index():
+    """回診病患索引；第一次查詢時由資料庫建立，之後整個程式共用"""
+    from patients import PatientIndex
+    return PatientIndex(get_store())
+
+@st.cache_resource
+def get_reports():
+    """歷次追蹤報告 (PDF) 的程序池；REPORT_FONT 可指定中文字型檔"""
+    from report import ReportRenderer
     try:
-        smtp_user = st.secrets["EMAIL_USER"]
-        smtp_password = st.secrets["EMAIL_PASSWORD"]
-        smtp_receiver = st.secrets["EMAIL_RECEIVER"]
+        font_path = st.secrets.get("REPORT_FONT")
     except Exception:
-        st.error("❌ 設定錯誤：請檢查 secrets.toml 中的 Email 設定")
-        return False
+        font_path = None
+    return ReportRenderer(get_store(), font_path=font_path)
 
-    msg = MIMEMultipart()
-    msg['From'] = smtp_user
-    msg['To'] = smtp_receiver
-    msg['Subject'] = subject
-    msg.attach(MIMEText(content, 'html'))
+@st.cache_resource
+def get_blood_chart():
+    """PBAC 參考圖只在程式啟動後第一次用到時處理一次；找不到圖檔回傳 None"""
+    import media
 
+    if not os.path.exists(media.CHART_SOURCE):
+        return None
+    variants = media.encode_variants()
     try:
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Sheet1')
-        output.seek(0)
-        
-        part = MIMEApplication(output.read(), Name=filename)
-        part['Content-Disposition'] = f'attachment; filename="{filename}"'
-        msg.attach(part)
-    except Exception as e:
-        st.error(f"❌ 附件製作失敗: {e}")
-        return False
+        media.publish(variants)
+    except OSError:
+        pass
+    return {
+        "html": media.picture_html(variants, caption="請對照此圖評估血量", alt="經血量參考圖示"),
+        "fallback": variants[-1][2],
+    }
 
-    try:
-        server = smtplib.SMTP_SSL('smtp.gmail.com', 465)
-        server.login(smtp_user, smtp_password)
-        server.send_message(msg)
-        server.quit()
-        return True
-    except Exception as e:
-        st.error(f"❌ 郵件發送失敗: {e}")
-        return False
+def show_delivery_status(submission_id):
+    """這份問卷的寄送狀態；已寄出或失敗就不會再變，只有還在排隊時才交給 delivery_pending 定時更新"""
+    from outbox import SENT, FAILED
+
+    info = get_outbox().status(submission_id)
+    if info is None:
+        return
+    if info["status"] == SENT:
+        st.info(f"📧 報告已寄出 (編號 #{submission_id})")
+    elif info["status"] == FAILED:
+        st.error(f"❌ 報告寄送失敗，資料已保留於本機，請聯繫管理員 (編號 #{submission_id})")
+    else:
+        delivery_pending(submission_id)
+
+@st.fragment(run_every=5)
+def delivery_pending(submission_id):
+    """尚未寄出時每 5 秒更新一次；寄出或失敗後重跑整頁，改由 show_delivery_status 顯示結果 (不再定時)"""
+    import mailer
+    from outbox import SENT, FAILED
+
+    outbox = get_outbox()
+    info = outbox.status(submission_id)
+    if info is None or info["status"] in (SENT, FAILED):
+        st.rerun()
+    # 預計寄出時間已包含排在前面的信件、寄送速度與每日配額
+    eta = outbox.eta(submission_id, window=mailer.load_digest_minutes() * 60)
+    when = f"，預計 {datetime.fromtimestamp(eta).strftime('%m/%d %H:%M')} 寄出" if eta else ""
+    if info["attempts"] == 0:
+        st.info(f"⏳ 報告排隊寄送中{when} (編號 #{submission_id})")
+    else:
+        st.warning(f"⏳ 報告寄送重試中{when}，第 {info['attempts']} 次失敗：{info['last_error']} (編號 #{submission_id})")
 
 # --- 4. Session State & Reset ---
 if 'step' not in st.session_state:
     st.session_state.step = 1
-if 'patient_data' not in st.session_state:
-    st.session_state.patient_data = {}
+if 'response' not in st.session_state:
+    st.session_state.response = Response()
+    # 重新整理或複製分頁時沿用網址上的冪等鍵
+    submission_key = st.query_params.get(SUBMISSION_PARAM)
+    if is_submission_key(submission_key):
+        st.session_state.response.submission_key = submission_key
+if 'trace_id' not in st.session_state:
+    st.session_state.trace_id = os.urandom(4).hex()
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = os.urandom(8).hex()
+metrics.set_trace(st.session_state.trace_id)
 
 def next_step(): st.session_state.step += 1
 def prev_step(): st.session_state.step -= 1
 
 def reset_app():
-    """清空所有資料並回到第一頁"""
+    """清空所有資料並回到第一頁
+
+    整個 session_state 一起清掉 (回覆紀錄、回診查詢結果、送出狀態，以及沒有 key 的姓名、
+    生日等輸入元件的值)，只保留 session 編號。
+    """
+    session_id = st.session_state.session_id
+    st.session_state.clear()
+    st.session_state.session_id = session_id
     st.session_state.step = 1
-    st.session_state.patient_data = {}
-    # 清除送出成功的狀態
-    if 'submit_success' in st.session_state:
-        del st.session_state['submit_success']
+    st.session_state.response = Response()
+    st.session_state.trace_id = os.urandom(4).hex()
+    st.query_params.pop(SUBMISSION_PARAM, None)
+
+def state_size():
+    """session 的估計大小 (可 pickle 的值)"""
+    import pickle
+
+    size = 0
+    for value in st.session_state.to_dict().values():
+        try:
+            size += len(pickle.dumps(value))
+        except Exception:
+            pass
+    return size
+
+def track_session(in_fragment=False):
+    """使用者每次操作 (整頁或 fragment 重跑) 時登記；此 session 若已因閒置或超出上限被清掉，先回到 Step 1"""
+    sessions = get_sessions()
+    # 先登記 (會檢查自己上次動作後是否已閒置逾時)，再看是否被清掉
+    evicted = sessions.touch(st.session_state.session_id, state_size())
+    if evicted:
+        metrics.count("session_evictions_total", amount=evicted)
+    if sessions.pop_evicted(st.session_state.session_id):
+        reset_app()
+        st.session_state.idle_reset = True
+        if in_fragment:
+            st.rerun(scope="app")
+
+@st.fragment(run_every=IDLE_CHECK_SECONDS)
+def idle_watch():
+    """定時檢查閒置 (不算使用者操作)：閒置逾時的 session (包含已關閉的分頁) 清空資料，自己被清掉時回到 Step 1"""
+    sessions = get_sessions()
+    evicted = sessions.sweep()
+    if evicted:
+        metrics.count("session_evictions_total", amount=evicted)
+    if sessions.pop_evicted(st.session_state.session_id):
+        # 停在空白的 Step 1 時不必提示
+        had_data = st.session_state.step != 1 or not st.session_state.response.is_empty()
+        reset_app()
+        st.session_state.idle_reset = had_data
+        st.rerun(scope="app")
+
+def prefill_returning_patient():
+    """病歷號碼輸入後查詢回診病患，帶入姓名、生日與下一個追蹤期間"""
+    from patients import next_followup
+
+    r = st.session_state.response
+    r.patient_id = st.session_state.p_id.strip()
+    with metrics.span("patient_lookup"):
+        visit = get_patient_index().lookup(r.patient_id)
+    previous = st.session_state.get("returning_visit")
+    st.session_state.returning_visit = visit
+    if visit is not None:
+        r.name, r.birth = visit.name, visit.birth or ""
+        r.followup = next_followup(visit.followup)
+    elif previous is not None:
+        # 改輸入其他病歷號：清掉前一位回診病患帶入的資料
+        r.name, r.birth, r.followup = "", "", ""
+    else:
+        return  # 新病患：不動已輸入的欄位
+    # 姓名等欄位有 key，元件值以 session_state 為準：一併寫入才會顯示帶入的資料
+    for key, value in basic_info_values(r).items():
+        if key != "p_id":
+            st.session_state[key] = value
+
+def basic_info_values(r):
+    """Step 1 各輸入元件 (依 key) 的值，取自回覆紀錄"""
+    birth = date(1980, 1, 1)
+    if r.birth:
+        try:
+            birth = datetime.strptime(r.birth, "%Y-%m-%d").date()
+        except ValueError:
+            pass
+    options = scoring.FOLLOWUP_OPTIONS
+    return {
+        "p_id": r.patient_id,
+        "p_name": r.name,
+        "p_birth": birth,
+        "p_followup": r.followup if r.followup in options else options[0],
+    }
 
-# --- 5. 側邊欄功能區 ---
+# --- 5. 問卷區塊 (fragment：區塊內的輸入變動只重跑該區塊，不重跑整頁) ---
+# 題目、選項與 HTML 都在 questionnaire.plans() 編譯好，這裡每次重跑只依計畫產生元件
+
+def timed_block(func):
+    """fragment 單獨重跑時不會經過頁首，在這裡補上 trace 編號並依量表計時"""
+    @functools.wraps(func)
+    def wrapper(key):
+        track_session(in_fragment=True)
+        with metrics.trace(st.session_state.trace_id), metrics.span("fragment", block=key):
+            return func(key)
+    return wrapper
+
+def instrument_inputs(plan, r):
+    """依呈現計畫畫出一個量表的輸入元件，回傳各題目前的值"""
+    answers = r.answers(plan)
+    if plan.kind == questionnaire.COUNT:
+        values = []
+        for section in plan.sections:
+            st.markdown('<div class="question-box">', unsafe_allow_html=True)
+            st.markdown(section.title_html, unsafe_allow_html=True)
+            if section.note:
+                st.markdown(section.note)
+            for column, item in zip(st.columns(len(section.items)), section.items):
+                with column:
+                    st.markdown(item.title)
+                    st.caption(item.caption)
+                    values.append(st.number_input(item.label, 0, plan.limit, key=item.key,
+                                                  label_visibility="collapsed", value=answers[len(values)]))
+            st.markdown('</div>', unsafe_allow_html=True)
+        return values
+
+    if plan.kind == questionnaire.SCALE:
+        item = plan.items[0]
+        return [st.select_slider(
+            label=item.label,
+            options=plan.options,
+            format_func=plan.format_option,
+            value=answers[0],
+            key=item.key
+        )]
+
+    values = []
+    for item, value in zip(plan.items, answers):
+        with st.container():
+            st.markdown(item.html, unsafe_allow_html=True)
+            val = st.radio(
+                item.label,
+                options=plan.options,
+                format_func=plan.format_option,
+                index=value,
+                key=item.key,
+                horizontal=True,
+                label_visibility="collapsed"
+            )
+            # 防止 NoneType 錯誤
+            values.append(0 if val is None else val)
+    return values
+
+@st.fragment
+@timed_block
+def instrument_block(key):
+    """Step 2 / 3 的一個量表：勾選「無困擾」或各題輸入，並即時顯示分數"""
+    plan = questionnaire.plan(key)
+    if plan.header_html:
+        st.markdown(plan.header_html, unsafe_allow_html=True)
+
+    r = st.session_state.response
+    none = st.checkbox(plan.none.label, key=plan.none.key, value=getattr(r, plan.none.key))
+
+    if not none:
+        answers = instrument_inputs(plan, r)
+        # 即時計算分數
+        with metrics.span("score", kind=plan.key):
+            score = plan.score_of(answers)
+        text = plan.feedback_text(score, answers)
+        if text:
+            getattr(st, plan.feedback.style)(text)
+    else:
+        getattr(st, plan.none.style)(plan.none.message)
+
+
+# --- 批次模式：整個步驟的輸入放在 st.form 裡，在瀏覽器端暫存，按「下一步」時一次送出 ---
+
+def load_input_mode():
+    """secrets.toml 的 INPUT_MODE："live" (預設，輸入即時更新) 或 "batch" (每步驟一次送出，適合網路慢的診間)"""
+    try:
+        mode = str(st.secrets.get("INPUT_MODE", INPUT_LIVE)).strip().lower()
+    except Exception:
+        return INPUT_LIVE
+    return mode if mode in (INPUT_LIVE, INPUT_BATCH) else INPUT_LIVE
+
+@functools.lru_cache(maxsize=None)
+def count_total_script(key):
+    """數量題 (PBAC) 的總分在瀏覽器端計算：讀取頁面上的輸入框，不必回伺服器"""
+    import json
+
+    plan = questionnaire.plan(key)
+    weights = json.dumps({item.label: item.weight for item in plan.items}, ensure_ascii=False)
+    return f"""
+    <div id="total" style="font-family:'Microsoft JhengHei',sans-serif; font-size:18px; color:#1B5E20;
+         background-color:#E8F5E9; padding:14px 18px; border-radius:8px;">📊 目前計算總分： <b>0 分</b></div>
+    <script>
+    const weights = {weights};
+    const noneLabel = {json.dumps(plan.none.label, ensure_ascii=False)};
+    const doc = window.parent.document;
+    function field(label) {{
+        const el = doc.querySelector(`[aria-label="${{label}}"]`);
+        return el && (el.tagName === "INPUT" ? el : el.querySelector("input"));
+    }}
+    function noneChecked() {{
+        for (const label of doc.querySelectorAll('label[data-baseweb="checkbox"]')) {{
+            if (label.textContent.includes(noneLabel)) return label.querySelector("input").checked;
+        }}
+        return false;
+    }}
+    function update() {{
+        let total = 0;
+        if (!noneChecked()) {{
+            for (const [label, weight] of Object.entries(weights)) {{
+                const input = field(label);
+                total += weight * (parseInt(input && input.value, 10) || 0);
+            }}
+        }}
+        document.querySelector("#total b").textContent = `${{total}} 分`;
+    }}
+    // +/- 按鈕改值時不一定觸發 input 事件，定時重算
+    update();
+    setInterval(update, 300);
+    </script>
+    """
+
+def instrument_batch_inputs(plan):
+    """批次模式：不隨勾選隱藏輸入 (表單內不會重跑)，勾選「無困擾」時送出後各題記為 0"""
+    if plan.header_html:
+        st.markdown(plan.header_html, unsafe_allow_html=True)
+    r = st.session_state.response
+    st.checkbox(plan.none.label, key=plan.none.key, value=getattr(r, plan.none.key))
+    instrument_inputs(plan, r)
+    if plan.kind == questionnaire.COUNT:
+        # 內容固定 (只含權重)，可與 Streamlit 同源存取頁面上的輸入框
+        st.iframe(count_total_script(plan.key), height=70)
+
+def step_inputs(step, batch):
+    """Step 2 / 3 的所有量表，量表之間以分隔線隔開"""
+    for i, plan in enumerate(questionnaire.for_step(step)):
+        if i:
+            st.markdown("---")
+        if batch:
+            instrument_batch_inputs(plan)
+        else:
+            instrument_block(plan.key)
+
+def step_form(name, batch):
+    """批次模式時整個步驟包在 st.form 裡，否則只是一般容器"""
+    return st.form(name, border=False) if batch else st.container()
+
+def step_buttons(next_label, batch):
+    """上一步 / 下一步；批次模式為表單的送出按鈕。回傳 (上一步, 下一步) 是否按下"""
+    button = st.form_submit_button if batch else st.button
+    col_back, col_next = st.columns([1, 1])
+    with col_back:
+        back = button("⬅️ 上一步")
+    with col_next:
+        forward = button(next_label)
+    return back, forward
+
+
+# fragment 各自重跑，「下一步」時再從元件狀態統一寫入回覆紀錄
+
+def save_step(step):
+    """Step 2 / 3 各量表的輸入寫入紀錄 (分數由紀錄自行計算)"""
+    r = st.session_state.response
+    for plan in questionnaire.for_step(step):
+        r.set_answers(
+            plan,
+            st.session_state.get(plan.none.key, False),
+            [st.session_state.get(item.key) for item in plan.items]
+        )
+
+@functools.lru_cache(maxsize=None)
+def summary_rows():
+    """Step 4 分數列的 HTML 開頭 (每個量表一列，只組一次)"""
+    return tuple(
+        (plan, f'<p><b>{plan.score.icon} {plan.score.label}：</b> <span style="color:#D84315; font-weight:bold;">')
+        for plan in questionnaire.plans()
+    )
+
+
+track_session()
+
+# --- 6. 側邊欄功能區 ---
 with st.sidebar:
     st.title("⚙️ 功能選單")
     st.info("此按鈕可隨時清除目前所有資料，並回到第一頁，方便下一位患者填寫。")
@@ -212,7 +642,15 @@ with st.sidebar:
         reset_app()
         st.rerun()
 
-# --- 6. 主程式 ---
+    idle_watch()
+
+# --- 7. 主程式 ---
+
+INPUT_MODE = load_input_mode()
+
+# 整頁重跑的耗時；以 st.rerun() 換頁的那次不計 (只是轉場)
+render_started = time.perf_counter()
+rendered_step = st.session_state.step
 
 st.markdown("<div class='main-header'>🏥 海扶治療中心 - 患者追蹤問卷</div>", unsafe_allow_html=True)
 progress_val = {1: 10, 2: 40, 3: 70, 4: 100}
@@ -221,35 +659,35 @@ st.progress(progress_val[st.session_state.step])
 # ================= STEP 1: 基本資料 =================
 if st.session_state.step == 1:
     st.markdown("<div class='step-header'>Step 1: 基本資料填寫</div>", unsafe_allow_html=True)
+    if st.session_state.pop("idle_reset", False):
+        st.info("⏱️ 因閒置過久，上一位的資料已自動清除。")
+    r = st.session_state.response
+    # 各元件都有 key：清空資料 (reset_app) 時隨 session_state 一起清掉，不會留下上一位打到一半的值
+    for key, value in basic_info_values(r).items():
+        if key not in st.session_state:
+            st.session_state[key] = value
     
     with st.container():
         col1, col2 = st.columns(2, gap="large")
         
         with col1:
-            p_id = st.text_input("病歷號碼", value=st.session_state.patient_data.get("id", ""), placeholder="請輸入病歷號")
-            p_name = st.text_input("姓名", value=st.session_state.patient_data.get("name", ""), placeholder="請輸入姓名")
+            p_id = st.text_input("病歷號碼", placeholder="請輸入病歷號",
+                                 key="p_id", on_change=prefill_returning_patient)
+            p_name = st.text_input("姓名", placeholder="請輸入姓名", key="p_name")
         
         with col2:
-            default_date = date(1980, 1, 1)
-            if "birth" in st.session_state.patient_data:
-                try:
-                    default_date = datetime.strptime(st.session_state.patient_data["birth"], "%Y-%m-%d").date()
-                except:
-                    pass
-
             p_birth_date = st.date_input(
                 "出生年月日 (可點選日曆)",
-                value=default_date,
                 min_value=date(1920, 1, 1),
-                max_value=date.today()
+                max_value=date.today(),
+                key="p_birth"
             )
             
-            options = ["海扶術前", "海扶術後", "術後3個月", "6個月", "1年", "2年", "3年", "4年以上"]
-            idx = 0
-            if "followup" in st.session_state.patient_data and st.session_state.patient_data["followup"] in options:
-                idx = options.index(st.session_state.patient_data["followup"])
-            
-            p_followup = st.selectbox("追蹤期間", options, index=idx)
+            p_followup = st.selectbox("追蹤期間", scoring.FOLLOWUP_OPTIONS, key="p_followup")
+
+    visit = st.session_state.get("returning_visit")
+    if visit is not None and p_id.strip() == r.patient_id:
+        st.info(f"🔁 回診病患：上次填寫「{visit.followup}」({visit.submitted_at[:10]})，已帶入基本資料，請確認後再按下一步。")
 
     st.markdown("<br>", unsafe_allow_html=True)
     
@@ -259,10 +697,11 @@ if st.session_state.step == 1:
             if not p_id or not p_name:
                 st.warning("⚠️ 請填寫 病歷號 與 姓名")
             else:
-                birth_str = p_birth_date.strftime("%Y-%m-%d")
-                st.session_state.patient_data.update({
-                    "id": p_id, "name": p_name, "birth": birth_str, "followup": p_followup
-                })
+                r.patient_id, r.name, r.followup = p_id.strip(), p_name, p_followup
+                r.birth = p_birth_date.strftime("%Y-%m-%d")
+                if not r.submission_key:
+                    r.submission_key = new_submission_key()
+                    st.query_params[SUBMISSION_PARAM] = r.submission_key
                 next_step()
                 st.rerun()
 
@@ -277,298 +716,162 @@ elif st.session_state.step == 2:
     **請填寫「數量」（片數/次數），系統會自動幫您算分。**
     """)
 
-    col_img, col_form = st.columns([1, 1.2], gap="large")
-    
-    with col_img:
-        st.markdown("### 🖼️ 參考圖示")
-        if os.path.exists("blood_chart.png"):
-            st.image("blood_chart.png", caption="請對照此圖評估血量", use_column_width=True)
-        else:
-            st.error("⚠️ 圖片 blood_chart.png 未找到")
-            st.markdown("請確認圖片已上傳至專案資料夾。")
-
-    with col_form:
-        no_blood = st.checkbox("我目前無月經 / 無經血困擾", value=st.session_state.patient_data.get("no_blood", False))
-
-        if not no_blood:
-            # ---區塊 1: 衛生棉---
-            st.markdown('<div class="question-box">', unsafe_allow_html=True)
-            st.markdown('<div class="question-title">🩸 1. 衛生棉 (使用總片數)</div>', unsafe_allow_html=True)
-            
-            c1, c2, c3 = st.columns(3)
-            with c1:
-                st.markdown("**輕微 (1分)**")
-                st.caption("僅沾染一點點")
-                pl = st.number_input("輕微-片數", 0, 100, key="pl", label_visibility="collapsed", value=st.session_state.patient_data.get("pl", 0))
-            with c2:
-                st.markdown("**中等 (5分)**")
-                st.caption("沾染約一半")
-                pm = st.number_input("中等-片數", 0, 100, key="pm", label_visibility="collapsed", value=st.session_state.patient_data.get("pm", 0))
-            with c3:
-                st.markdown("**大量 (20分)**")
-                st.caption("整片全濕")
-                ph = st.number_input("大量-片數", 0, 100, key="ph", label_visibility="collapsed", value=st.session_state.patient_data.get("ph", 0))
-            st.markdown('</div>', unsafe_allow_html=True)
-
-            # ---區塊 2: 棉條---
-            st.markdown('<div class="question-box">', unsafe_allow_html=True)
-            st.markdown('<div class="question-title">🧶 2. 棉條 (使用總支數)</div>', unsafe_allow_html=True)
-            st.markdown("*若無使用請留白或填 0*")
-            
-            c4, c5, c6 = st.columns(3)
-            with c4:
-                st.markdown("**輕微 (1分)**")
-                st.caption("僅一點點")
-                tl = st.number_input("棉輕-支數", 0, 100, key="tl", label_visibility="collapsed", value=st.session_state.patient_data.get("tl", 0))
-            with c5:
-                st.markdown("**中等 (5分)**")
-                st.caption("約一半")
-                tm = st.number_input("棉中-支數", 0, 100, key="tm", label_visibility="collapsed", value=st.session_state.patient_data.get("tm", 0))
-            with c6:
-                st.markdown("**大量 (10分)**")
-                st.caption("整根全濕")
-                th = st.number_input("棉大-支數", 0, 100, key="th", label_visibility="collapsed", value=st.session_state.patient_data.get("th", 0))
-            st.markdown('</div>', unsafe_allow_html=True)
+    # 批次模式：輸入框在瀏覽器端暫存，按上一步 / 下一步時才連同所有數量一次送出
+    batch = INPUT_MODE == INPUT_BATCH
+    with step_form("pbac_step", batch):
+        col_img, col_form = st.columns([1, 1.2], gap="large")
+        
+        with col_img:
+            st.markdown("### 🖼️ 參考圖示")
+            chart = get_blood_chart()
+            if chart is not None:
+                if st.get_option("server.enableStaticServing"):
+                    st.markdown(chart["html"], unsafe_allow_html=True)
+                else:
+                    # 未開啟 static 服務時退回 st.image；內容不變時網址也不變，瀏覽器不會重抓
+                    st.image(chart["fallback"], caption="請對照此圖評估血量", width="stretch")
+            else:
+                st.error("⚠️ 圖片 blood_chart.png 未找到")
+                st.markdown("請確認圖片已上傳至專案資料夾。")
 
-            # ---區塊 3: 血塊與意外---
-            st.markdown('<div class="question-box">', unsafe_allow_html=True)
-            st.markdown('<div class="question-title">⚠️ 3. 血塊與滲漏 (發生次數)</div>', unsafe_allow_html=True)
-            
-            c7, c8, c9 = st.columns(3)
-            with c7:
-                st.markdown("**小血塊 (1分)**")
-                st.caption("像1元硬幣大小")
-                cs = st.number_input("小血塊-次數", 0, 100, key="cs", label_visibility="collapsed", value=st.session_state.patient_data.get("cs", 0))
-            with c8:
-                st.markdown("**大血塊 (5分)**")
-                st.caption("大於1元硬幣")
-                cl = st.number_input("大血塊-次數", 0, 100, key="cl", label_visibility="collapsed", value=st.session_state.patient_data.get("cl", 0))
-            with c9:
-                st.markdown("**滲漏 (5分)**")
-                st.caption("溢出沾到褲子")
-                ac = st.number_input("滲漏-次數", 0, 100, key="ac", label_visibility="collapsed", value=st.session_state.patient_data.get("ac", 0))
-            st.markdown('</div>', unsafe_allow_html=True)
+        with col_form:
+            step_inputs(2, batch)
 
-            # 即時計算分數
-            score = calculate_blood_score(pl, pm, ph, tl, tm, th, cs, cl, ac)
-            st.success(f"📊 目前計算總分： **{score} 分**")
-            
-        else:
-            pl=pm=ph=tl=tm=th=cs=cl=ac=0
-            score = 0
-            st.info("已選擇無經血困擾，分數為 0 分。")
+        st.markdown("<br>", unsafe_allow_html=True)
+        go_back, go_next = step_buttons("下一步 ➡️", batch)
 
-    st.markdown("<br>", unsafe_allow_html=True)
-    col_back, col_next = st.columns([1, 1])
-    with col_back:
-        if st.button("⬅️ 上一步"):
-            prev_step()
-            st.rerun()
-    with col_next:
-        if st.button("下一步 ➡️"):
-            st.session_state.patient_data.update({
-                "no_blood": no_blood, "blood_score": score,
-                "pl": pl, "pm": pm, "ph": ph,
-                "tl": tl, "tm": tm, "th": th,
-                "cs": cs, "cl": cl, "ac": ac
-            })
-            next_step()
-            st.rerun()
+    if go_back:
+        if batch:
+            # 表單送出的數量只在這一次重跑可讀到，先存起來，回到此步驟時仍在
+            save_step(2)
+        prev_step()
+        st.rerun()
+    if go_next:
+        save_step(2)
+        next_step()
+        st.rerun()
 
 # ================= STEP 3: 疼痛與頻尿 =================
 elif st.session_state.step == 3:
     st.markdown("<div class='step-header'>Step 3: 症狀評估</div>", unsafe_allow_html=True)
 
-    # --- 1. 經痛評估 (視覺化改良版) ---
-    st.markdown("""
-    <div style="background-color:#FFEBEE; padding:15px; border-radius:10px; border-left:5px solid #E57373; margin-bottom:20px;">
-        <h3 style="color:#C62828; margin:0;">⚡ 1. 經痛程度</h3>
-        <p style="color:#555; margin-top:5px;">請依照您<b>「最痛的時候」</b>的感覺，滑動下方拉桿選擇。</p>
-    </div>
-    """, unsafe_allow_html=True)
-
-    no_pain = st.checkbox("😊 我完全沒有經痛困擾", value=st.session_state.patient_data.get("no_pain", False))
-
-    if not no_pain:
-        # 定義表情符號
-        pain_options = {
-            0: "0 (無痛) 😊", 1: "1 😐", 2: "2 (輕微) 🙂", 3: "3 😐",
-            4: "4 (中等) 😣", 5: "5 😣", 6: "6 (強烈) 😖", 7: "7 😖",
-            8: "8 (劇烈) 😭", 9: "9 😭", 10: "10 (無法忍受) 🚑"
-        }
-        
-        default_val = st.session_state.patient_data.get("pain_val", 0)
-        
-        pain_selection = st.select_slider(
-            label="請左右滑動選擇痛感：",
-            options=list(pain_options.keys()),
-            format_func=lambda x: pain_options[x],
-            value=default_val
-        )
-        st.info(f"您選擇的是： **{pain_options[pain_selection]}**")
-        pain_val = pain_selection
-    else:
-        pain_val = 0
-        st.success("已記錄：無經痛。")
-
-    st.markdown("---")
+    batch = INPUT_MODE == INPUT_BATCH
+    with step_form("symptoms_step", batch):
+        # 經痛 (VAS 量尺) 與頻尿/漏尿 (UDI-6 卡片)
+        step_inputs(3, batch)
 
-    # --- 2. 頻尿/漏尿評估 (卡片式改良版) ---
-    st.markdown("""
-    <div style="background-color:#E3F2FD; padding:15px; border-radius:10px; border-left:5px solid #2196F3; margin-bottom:20px;">
-        <h3 style="color:#1565C0; margin:0;">🚽 2. 排尿與頻尿狀況</h3>
-        <p style="color:#555; margin-top:5px;">請勾選以下症狀對您生活的<b>「困擾程度」</b>。</p>
-    </div>
-    """, unsafe_allow_html=True)
-    
-    no_udi = st.checkbox("🌟 我排尿都很正常，無任何困擾", value=st.session_state.patient_data.get("no_udi", False))
-    
-    # 題目定義
-    udi_items = [
-        {"icon": "🏃‍♀️", "title": "頻尿", "desc": "覺得小便次數太頻繁？"},
-        {"icon": "🌊", "title": "急迫性漏尿", "desc": "有尿意時來不及跑到廁所就漏出來？"},
-        {"icon": "🤧", "title": "應力性漏尿", "desc": "咳嗽、打噴嚏或運動時會漏尿？"},
-        {"icon": "💧", "title": "滴尿", "desc": "小便量少，滴滴答答解不乾淨？"},
-        {"icon": "😣", "title": "排尿困難", "desc": "小便排不出來，需要用力壓肚子？"},
-        {"icon": "💥", "title": "疼痛", "desc": "下腹部或骨盆會感到疼痛或不舒服？"}
-    ]
-    option_map = {0: "完全沒有", 1: "有一點", 2: "滿困擾", 3: "非常嚴重"}
-    udi_scores = []
-
-    if not no_udi:
-        for i, item in enumerate(udi_items):
-            with st.container():
-                st.markdown(f"""
-                <div class="udi-card">
-                    <div class="udi-title">{item['icon']} {item['title']}</div>
-                    <div class="udi-desc">{item['desc']}</div>
-                </div>
-                """, unsafe_allow_html=True)
-                
-                val = st.radio(
-                    f"udi_q_{i}", 
-                    options=[0, 1, 2, 3],
-                    format_func=lambda x: f"{option_map[x]} ({x})",
-                    index=st.session_state.patient_data.get(f"udi_{i}", 0),
-                    key=f"radio_udi_{i}",
-                    horizontal=True,
-                    label_visibility="collapsed"
-                )
-                
-                # --- [修正] 防止 NoneType 錯誤的關鍵 ---
-                if val is None:
-                    val = 0
-                # -----------------------------------
-                
-                udi_scores.append(val)
-                
-        udi_total = sum(udi_scores)
-        if udi_total > 0:
-            st.warning(f"頻尿困擾總分：{udi_total} 分")
-    else:
-        udi_scores = [0]*6
-        udi_total = 0
-        st.success("已記錄：排尿正常。")
+        st.markdown("<br>", unsafe_allow_html=True)
+        go_back, go_next = step_buttons("完成並預覽 ➡️", batch)
 
-    st.markdown("<br>", unsafe_allow_html=True)
-    col_back, col_next = st.columns([1, 1])
-    with col_back:
-        if st.button("⬅️ 上一步"):
-            prev_step()
-            st.rerun()
-    with col_next:
-        if st.button("完成並預覽 ➡️"):
-            udi_data = {f"udi_{i}": v for i, v in enumerate(udi_scores)}
-            st.session_state.patient_data.update({
-                "no_pain": no_pain, "pain_val": pain_val,
-                "no_udi": no_udi, "udi_total": udi_total
-            })
-            st.session_state.patient_data.update(udi_data)
-            next_step()
-            st.rerun()
+    if go_back:
+        if batch:
+            save_step(3)
+        prev_step()
+        st.rerun()
+    if go_next:
+        save_step(3)
+        next_step()
+        st.rerun()
 
 # ================= STEP 4: 確認與提交 =================
 elif st.session_state.step == 4:
     st.markdown("<div class='step-header'>Step 4: 確認資料與送出</div>", unsafe_allow_html=True)
     
-    d = st.session_state.patient_data
+    d = st.session_state.response
     
     with st.container():
         st.markdown(f"""
         <div style="background-color:#fff; padding:20px; border-radius:10px; border:1px solid #ddd; font-size:18px;">
-            <p><b>👤 姓名：</b> {d.get('name')}</p>
-            <p><b>📅 出生日期：</b> {d.get('birth')}</p>
-            <p><b>🏥 病歷號：</b> {d.get('id')}</p>
-            <p><b>🕒 追蹤期：</b> {d.get('followup')}</p>
+            <p><b>👤 姓名：</b> {d.name}</p>
+            <p><b>📅 出生日期：</b> {d.birth}</p>
+            <p><b>🏥 病歷號：</b> {d.patient_id}</p>
+            <p><b>🕒 追蹤期：</b> {d.followup}</p>
             <hr>
-            <p><b>🩸 經血分數：</b> <span style="color:#D84315; font-weight:bold;">{d.get('blood_score')} 分</span></p>
-            <p><b>⚡ 經痛分數：</b> <span style="color:#D84315; font-weight:bold;">{d.get('pain_val')} 分</span></p>
-            <p><b>🚽 頻尿分數：</b> <span style="color:#D84315; font-weight:bold;">{d.get('udi_total')} 分</span></p>
+            {"".join(f"{row}{d.score(plan)} 分</span></p>" for plan, row in summary_rows())}
         </div>
         """, unsafe_allow_html=True)
 
     st.markdown("<br>", unsafe_allow_html=True)
     col_back, col_submit = st.columns([1, 1])
+    # 送出後停用按鈕，連點或重跑時的第二次點擊不會再送一次
+    submitted = st.session_state.get('submit_success', False)
     
     with col_back:
-        if st.button("⬅️ 返回修改"):
+        if st.button("⬅️ 返回修改", disabled=submitted):
             prev_step()
             st.rerun()
     
     with col_submit:
-        if st.button("✅ 確認送出 (Submit)"):
-            with st.spinner("📩 正在發送報告，請稍候..."):
-                now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                
-                raw_data = {
-                    "病歷號碼": [d['id']],
-                    "姓名": [d['name']],
-                    "出生年月日": [d['birth']],
-                    "追蹤期間": [d['followup']],
-                    "填寫時間": [now_str],
-                    "經血分數(PBAC)": [d['blood_score']],
-                    "經痛分數(VAS)": [d['pain_val']],
-                    "頻尿分數(UDI)": [d['udi_total']],
-                    "經血明細": [f"Pad:{d['pl']}/{d['pm']}/{d['ph']}, Tam:{d['tl']}/{d['tm']}/{d['th']}, Clot:{d['cs']}/{d['cl']}"],
-                    "頻尿明細": [str([d[f'udi_{i}'] for i in range(6)])]
-                }
-                df = pd.DataFrame(raw_data)
-                
-                filename = f"{d['name']}_{d['followup']}_Report.xlsx"
-                email_content = f"""
-                <h2 style="color:#00695C;">海扶中心 - 問卷回覆通知</h2>
-                <hr>
-                <p><b>姓名：</b>{d['name']}</p>
-                <p><b>病歷號：</b>{d['id']}</p>
-                <p><b>追蹤期間：</b>{d['followup']}</p>
-                <p><b>總結分數：</b></p>
-                <ul>
-                    <li>經血: {d['blood_score']}</li>
-                    <li>經痛: {d['pain_val']}</li>
-                    <li>頻尿: {d['udi_total']}</li>
-                </ul>
-                <p>詳細數據請查閱附件 Excel。</p>
-                """
-                
-                success = send_email_via_gmail(
-                    subject=f"【問卷】{d['name']} - {d['followup']}",
-                    content=email_content,
-                    df=df,
-                    filename=filename
-                )
-                
-                if success:
-                    st.session_state['submit_success'] = True
-                    st.rerun()
-                else:
-                    st.error("❌ 傳送失敗，請聯繫管理員。")
+        if st.button("✅ 確認送出 (Submit)", disabled=submitted):
+            now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+            import mailer
+
+            filename = f"{d.name}_{d.followup}_Report.xlsx"
+            email_content = mailer.summary_html(d)
+
+            # 經血或經痛分數達門檻的問卷優先寄出
+            from outbox import PRIORITY_NORMAL, PRIORITY_URGENT
+            from store import SubmissionConflict
+            urgent_pbac, urgent_vas = mailer.load_urgent_thresholds()
+            urgent = bool(urgent_pbac and d.blood_score >= urgent_pbac) or bool(urgent_vas and d.pain_val >= urgent_vas)
+
+            # 只寫入本機資料庫與暫存區，寄信交給背景執行緒。
+            # 同一 submission_key 重複送出 (重跑、其他分頁或同一台主機上的其他程序) 時兩邊都沿用第一次的紀錄
+            try:
+                with metrics.span("submit"):
+                    with metrics.span("store_insert"):
+                        try:
+                            _, created = get_store().insert(d, submitted_at=now_str)
+                        except SubmissionConflict:
+                            # 網址上的 key 屬於另一份問卷 (例如複製了前一位的網址)：換新的 key
+                            d.submission_key = new_submission_key()
+                            st.query_params[SUBMISSION_PARAM] = d.submission_key
+                            _, created = get_store().insert(d, submitted_at=now_str)
+                    if created:
+                        get_patient_index().add(d, now_str)
+                    with metrics.span("enqueue"):
+                        submission_id = get_outbox().enqueue(
+                            subject=f"【問卷{'・急' if urgent else ''}】{d.name} - {d.followup}",
+                            content=email_content,
+                            filename=filename,
+                            rows=[d.report_row(now_str)],
+                            priority=PRIORITY_URGENT if urgent else PRIORITY_NORMAL,
+                            submission_key=d.submission_key or None
+                        )
+            except Exception as e:
+                metrics.count("submission_failures_total")
+                st.error(f"❌ 儲存失敗，請聯繫管理員: {e}")
+            else:
+                metrics.count("submissions_total" if created else "duplicate_submissions_total")
+                # 在背景程序池更新此病患的歷次追蹤報告，失敗不影響送出
+                try:
+                    if created:
+                        get_reports().request(d.patient_id)
+                except Exception:
+                    metrics.count("report_failures_total")
+                st.session_state['submission_id'] = submission_id
+                st.session_state['submit_success'] = True
+                st.session_state['celebrate'] = True
+                st.rerun()
 
     # 如果成功送出，顯示成功訊息與「下一位」按鈕
     if st.session_state.get('submit_success', False):
-        st.success("✅ 問卷已成功送出！")
-        st.balloons()
+        st.success("✅ 問卷已儲存！報告將自動寄出。")
+        # 寄出後整頁重跑顯示結果時不再放一次氣球
+        if st.session_state.pop('celebrate', False):
+            st.balloons()
+        show_delivery_status(st.session_state['submission_id'])
         
         # 這裡的按鈕邏輯跟側邊欄一模一樣，確保清空資料並回到第一頁
         if st.button("🔄 填寫下一位 (清空資料)"):
             reset_app() # 呼叫清空函式
             st.rerun()  # 重跑網頁
+
+metrics.observe("render", time.perf_counter() - render_started, step=rendered_step)
+
+# 畫面都送出後才開始背景預載 (每個程式只執行一次)
+warm_up_submission_stack()
+start_metrics()
+start_export_api()
+start_delivery()
@@ -0,0 +1,150 @@
+import csv
+import io
+import json
+import os
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+# 報告附件產生器：不經過 pandas / openpyxl，直接寫出最精簡的 xlsx。
+# 相同輸入一定產生相同位元組 (固定時間戳記與檔案順序)，方便比對與快取。
+
+FORMATS = ("xlsx", "csv", "json")
+
+# 附件的 MIME 類型 (maintype, subtype)：csv 依 RFC 4180 為 text/csv，不是 application/csv
+MIME_TYPES = {
+    "xlsx": ("application", "vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": ("text", "csv"),
+    "json": ("application", "json"),
+}
+
+# 信件內文提到附件時的稱呼
+LABELS = {"xlsx": "Excel", "csv": "CSV", "json": "JSON"}
+
+_ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+
+# XML 1.0 不允許的控制字元
+_ILLEGAL_XML = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '</Types>'
+)
+_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets>'
+    '</workbook>'
+)
+_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet1.xml"/>'
+    '</Relationships>'
+)
+_SHEET_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+)
+_SHEET_TAIL = '</sheetData></worksheet>'
+
+
+def _columns(rows):
+    """欄位順序：依第一次出現的順序 (與 pd.DataFrame(rows) 相同)"""
+    columns = {}
+    for row in rows:
+        for key in row:
+            columns.setdefault(key, None)
+    return list(columns)
+
+
+def _col_letter(index):
+    letters = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def _cell(ref, value):
+    if value is None:
+        return ""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c r="{ref}"><v>{value}</v></c>'
+    text = escape(_ILLEGAL_XML.sub("", str(value)))
+    return f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _zip_entry(name):
+    info = zipfile.ZipInfo(name, date_time=_ZIP_DATE)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o600 << 16
+    return info
+
+
+def write_xlsx(rows, out):
+    """將 rows (dict 串列) 寫成單一工作表 Sheet1 的 xlsx，逐列串流寫入 out"""
+    columns = _columns(rows)
+    letters = [_col_letter(i) for i in range(len(columns))]
+    with zipfile.ZipFile(out, "w") as zf:
+        zf.writestr(_zip_entry("[Content_Types].xml"), _CONTENT_TYPES)
+        zf.writestr(_zip_entry("_rels/.rels"), _ROOT_RELS)
+        zf.writestr(_zip_entry("xl/workbook.xml"), _WORKBOOK)
+        zf.writestr(_zip_entry("xl/_rels/workbook.xml.rels"), _WORKBOOK_RELS)
+        with zf.open(_zip_entry("xl/worksheets/sheet1.xml"), "w") as sheet:
+            sheet.write(_SHEET_HEAD.encode())
+            header = "".join(_cell(f"{c}1", name) for c, name in zip(letters, columns))
+            sheet.write(f'<row r="1">{header}</row>'.encode())
+            for r, row in enumerate(rows, start=2):
+                cells = "".join(_cell(f"{c}{r}", row.get(name)) for c, name in zip(letters, columns))
+                sheet.write(f'<row r="{r}">{cells}</row>'.encode())
+            sheet.write(_SHEET_TAIL.encode())
+
+
+def write_csv(rows, out):
+    # utf-8-sig：Excel 直接開啟時中文不會變亂碼
+    text = io.TextIOWrapper(out, encoding="utf-8-sig", newline="")
+    writer = csv.DictWriter(text, fieldnames=_columns(rows), lineterminator="\r\n")
+    writer.writeheader()
+    writer.writerows(rows)
+    text.flush()
+    text.detach()
+
+
+def write_json(rows, out):
+    out.write(json.dumps(rows, ensure_ascii=False, indent=1).encode())
+
+
+_WRITERS = {"xlsx": write_xlsx, "csv": write_csv, "json": write_json}
+
+
+def build(rows, fmt="xlsx"):
+    """產生附件內容 (bytes)"""
+    if fmt not in _WRITERS:
+        raise ValueError(f"不支援的附件格式: {fmt}")
+    out = io.BytesIO()
+    _WRITERS[fmt](rows, out)
+    return out.getvalue()
+
+
+def with_extension(filename, fmt):
+    return f"{os.path.splitext(filename)[0]}.{fmt}"
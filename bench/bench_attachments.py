@@ -0,0 +1,74 @@
+"""附件產生效能比較：pandas + openpyxl (舊作法) vs attachments 直接寫出
+
+用法: python bench/bench_attachments.py [--rows 1] [--repeat 200]
+"""
+import argparse
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import attachments  # noqa: E402
+
+SAMPLE_ROW = {
+    "病歷號碼": "A1234567",
+    "姓名": "王小明",
+    "出生年月日": "1980-01-01",
+    "追蹤期間": "術後3個月",
+    "填寫時間": "2024-05-01 10:30:00",
+    "經血分數(PBAC)": 128,
+    "經痛分數(VAS)": 6,
+    "頻尿分數(UDI)": 7,
+    "經血明細": "Pad:3/2/4, Tam:0/1/0, Clot:2/1",
+    "頻尿明細": "[1, 2, 0, 1, 3, 0]",
+}
+
+
+def pandas_xlsx(rows):
+    import pandas as pd
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+        pd.DataFrame(rows).to_excel(writer, index=False, sheet_name="Sheet1")
+    return output.getvalue()
+
+
+def measure(fn, rows, repeat):
+    fn(rows)  # 預熱 (含 import)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(rows)
+    per_call = (time.perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    fn(rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return per_call, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    rows = [dict(SAMPLE_ROW) for _ in range(args.rows)]
+    cases = [("pandas+openpyxl xlsx", pandas_xlsx)]
+    cases += [(f"attachments {fmt}", lambda r, fmt=fmt: attachments.build(r, fmt)) for fmt in attachments.FORMATS]
+
+    print(f"rows={args.rows} repeat={args.repeat}")
+    print(f"{'path':<24}{'ms/op':>10}{'peak KiB':>12}{'bytes':>10}")
+    for name, fn in cases:
+        per_call, peak = measure(fn, rows, args.repeat)
+        print(f"{name:<24}{per_call * 1000:>10.3f}{peak / 1024:>12.1f}{len(fn(rows)):>10}")
+
+    # 決定性檢查：同樣的輸入必須得到相同位元組
+    for fmt in attachments.FORMATS:
+        assert attachments.build(rows, fmt) == attachments.build(rows, fmt), fmt
+
+
+if __name__ == "__main__":
+    main()
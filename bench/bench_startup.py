@@ -0,0 +1,82 @@
+"""冷啟動量測：全新 Python 程序畫出 Step 1 所需時間，並檢查有沒有提早載入重量級模組
+
+用法: python bench/bench_startup.py [--runs 5] [--json]
+每次改版後執行一次，把 --json 的輸出附在版本紀錄即可追蹤趨勢。
+每次都在暫存資料夾的 app 副本上執行 (同 bench_suite.py)，不會建立專案的 data/，
+也不會用開發者的 secrets.toml 啟動真的寄信工作。
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Step 1 不應該用到的模組
+HEAVY_MODULES = ("pandas", "numpy", "openpyxl", "pyarrow", "smtplib", "email.mime.multipart", "sqlite3")
+
+_CHILD = r"""
+import json, sys, threading, time
+launched = float(sys.argv[1])
+imports = []
+sys.addaudithook(lambda event, args: event == "import" and imports.append((args[0], threading.current_thread().name)))
+
+from streamlit.testing.v1 import AppTest
+script_start = time.time()
+at = AppTest.from_file(sys.argv[2], default_timeout=60).run()
+done = time.time()
+
+assert not at.exception, at.exception
+assert any("Step 1" in m.value for m in at.markdown), "Step 1 沒有畫出來"
+heavy = sorted({h for name, thread in imports if thread != "warm-up"
+                for h in sys.argv[3:] if name == h or name.startswith(h + ".")})
+print(json.dumps({"first_render": done - launched, "script": done - script_start, "heavy": heavy}))
+"""
+
+
+def run_once():
+    import loadtest
+
+    # 寄信指向本機不存在的埠：寄送工作照常啟動，但不會真的寄出
+    sandbox = loadtest.prepare_sandbox(smtp_port=1, sandbox=tempfile.mkdtemp(prefix="hifu-startup-"))
+    try:
+        launched = time.time()
+        out = subprocess.run(
+            [sys.executable, "-c", _CHILD, str(launched), os.path.join(sandbox, "app.py"), *HEAVY_MODULES],
+            cwd=sandbox, capture_output=True, text=True, check=True,
+        )
+    finally:
+        shutil.rmtree(sandbox, ignore_errors=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="只輸出一行 JSON 結果")
+    args = parser.parse_args()
+
+    results = [run_once() for _ in range(args.runs)]
+    summary = {
+        "runs": args.runs,
+        "first_render_median_ms": round(statistics.median(r["first_render"] for r in results) * 1000, 1),
+        "script_median_ms": round(statistics.median(r["script"] for r in results) * 1000, 1),
+        "heavy_modules_before_first_render": sorted({m for r in results for m in r["heavy"]}),
+    }
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False))
+        return
+    print(f"Step 1 首次畫面 (含直譯器與 streamlit 啟動)  中位數 {summary['first_render_median_ms']} ms")
+    print(f"app.py 第一次執行                              中位數 {summary['script_median_ms']} ms")
+    heavy = summary["heavy_modules_before_first_render"]
+    print("畫出 Step 1 前載入的重量級模組:", ", ".join(heavy) if heavy else "無")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""回歸把關的效能基準：計分、附件、通知信組裝與每一步的整頁重跑
+
+用法:
+    python bench/bench_suite.py                 與 bench/baseline.json 比較，有退步時結束碼為 1
+    python bench/bench_suite.py --update        重新量測並寫入 baseline.json
+    python bench/bench_suite.py --only score_pbac,email_html --threshold 0.3
+
+每個項目記錄每次呼叫的耗時 (多輪取最快一輪的平均，減少雜訊) 與 tracemalloc 的峰值記憶體。
+整頁重跑用 Streamlit 的 AppTest 在暫存資料夾的 app 副本上執行，不需要網路也不碰正式資料。
+基準值與機器有關：換機器或升級 Python / Streamlit 後請先 --update。
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import attachments  # noqa: E402
+import metrics  # noqa: E402
+import questionnaire  # noqa: E402
+from record import Response  # noqa: E402
+
+BASELINE_PATH = os.path.join(ROOT, "bench", "baseline.json")
+THRESHOLD = 0.25         # 耗時超過基準 25% 視為退步
+MEMORY_THRESHOLD = 0.20  # 峰值記憶體超過基準 20% 視為退步
+# 極小的數值抖動不算退步
+NOISE_MS = 0.002
+NOISE_KIB = 2.0
+
+SUBMITTED_AT = "2024-05-01 10:30:00"
+
+
+def sample_response():
+    r = Response()
+    r.patient_id, r.name, r.birth, r.followup = "A1234567", "王小明", "1980-01-01", "術後3個月"
+    r.submission_key = "0" * 32
+    r.set_answers(questionnaire.plan("pbac"), False, (3, 2, 4, 0, 1, 0, 2, 1, 1))
+    r.set_answers(questionnaire.plan("vas"), False, (6,))
+    r.set_answers(questionnaire.plan("udi"), False, (1, 2, 0, 1, 3, 0))
+    return r
+
+
+# --- 1. 量測項目 ---
+
+def unit_cases():
+    """(名稱, 函數, 每輪呼叫次數)"""
+    record = sample_response()
+    row = record.report_row(SUBMITTED_AT)
+    pbac = questionnaire.plan("pbac")
+    counts = tuple(record.answers(pbac))
+
+    def score_pbac():
+        # 與 app.py 的 instrument_block 相同：依呈現計畫計分並計時
+        with metrics.span("score", kind=pbac.key):
+            return pbac.score_of(counts)
+
+    def email_html():
+        import mailer
+
+        config = {"user": "bench@example.com", "receiver": "clinic@example.com"}
+        content = mailer.summary_html(record, "xlsx")
+        attachment = attachments.build([row], "xlsx")
+        msg = mailer.build_message(config, f"【問卷】{record.name} - {record.followup}", content, attachment,
+                                   f"{record.name}_{record.followup}_Report.xlsx")
+        return msg.as_bytes()
+
+    return [
+        ("score_pbac", score_pbac, 20000),
+        ("attachment_xlsx", lambda: attachments.build([record.report_row(SUBMITTED_AT)], "xlsx"), 500),
+        ("email_html", email_html, 300),
+    ]
+
+
+def rerun_cases():
+    """依序產生每一步的整頁重跑 (產生下一項前才前進到下一步)"""
+    import loadtest
+    from streamlit.testing.v1 import AppTest
+
+    cwd = os.getcwd()
+    sandbox = loadtest.prepare_sandbox(smtp_port=1, sandbox=tempfile.mkdtemp(prefix="hifu-bench-"))
+    os.chdir(sandbox)
+    try:
+        at = AppTest.from_file(os.path.join(sandbox, "app.py"), default_timeout=60).run()
+
+        def rerun():
+            at.run()
+            assert not at.exception, at.exception
+
+        def advance(label):
+            next(b for b in at.button if label in (b.label or "")).click().run()
+            assert not at.exception, at.exception
+
+        at.text_input[0].input("A1234567")
+        at.text_input[1].input("王小明")
+        yield "rerun_step1", rerun, 5
+        advance("下一步")
+        yield "rerun_step2", rerun, 5
+        advance("下一步")
+        yield "rerun_step3", rerun, 5
+        advance("完成並預覽")
+        yield "rerun_step4", rerun, 5
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(sandbox, ignore_errors=True)
+
+
+def measure(fn, number, rounds):
+    fn()  # 預熱 (含 import 與快取)
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - start) / number)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"ms": round(best * 1000, 4), "peak_kib": round(peak / 1024, 1)}
+
+
+# --- 2. 與基準比較 ---
+
+def compare(result, base, threshold, memory_threshold):
+    """回傳退步說明的清單 (空清單表示通過)"""
+    problems = []
+    if result["ms"] > base["ms"] * (1 + threshold) + NOISE_MS:
+        problems.append(f"耗時 {result['ms'] / base['ms'] - 1:+.0%}")
+    if result["peak_kib"] > base["peak_kib"] * (1 + memory_threshold) + NOISE_KIB:
+        problems.append(f"記憶體 {result['peak_kib'] / base['peak_kib'] - 1:+.0%}")
+    return problems
+
+
+def environment():
+    import streamlit
+
+    return {"python": platform.python_version(), "streamlit": streamlit.__version__, "machine": platform.machine()}
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--update", action="store_true", help="將這次結果寫入基準檔")
+    parser.add_argument("--only", help="以逗號分隔的項目名稱 (預設全部)")
+    parser.add_argument("--rounds", type=int, default=5, help="每個項目量測幾輪，取最快一輪")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--memory-threshold", type=float, default=MEMORY_THRESHOLD)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--json", action="store_true", help="只輸出一行 JSON 結果")
+    args = parser.parse_args(argv)
+
+    only = set(args.only.split(",")) if args.only else None
+    results = {}
+    cases = unit_cases()
+    if only is None or any(name.startswith("rerun_") for name in only):
+        cases = [*cases, rerun_cases()]
+    for case in cases:
+        for name, fn, number in ([case] if isinstance(case, tuple) else case):
+            if only is None or name in only:
+                results[name] = measure(fn, number, args.rounds)
+
+    baseline = load_baseline(args.baseline)
+    if args.update:
+        cases = {**(baseline or {}).get("cases", {}), **results}
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"environment": environment(), "cases": cases}, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+
+    regressions = {}
+    known = (baseline or {}).get("cases", {})
+    if not args.update:
+        for name, result in results.items():
+            if name in known:
+                problems = compare(result, known[name], args.threshold, args.memory_threshold)
+                if problems:
+                    regressions[name] = problems
+
+    if args.json:
+        print(json.dumps({"results": results, "regressions": regressions}, ensure_ascii=False))
+        return 1 if regressions else 0
+
+    if baseline is not None and baseline.get("environment") != environment():
+        print(f"⚠️ 基準檔的環境 {baseline.get('environment')} 與目前 {environment()} 不同，比較僅供參考")
+    print(f"{'項目':<24}{'ms/次':>10}{'基準':>10}{'峰值 KiB':>11}{'基準':>9}  結果")
+    for name, result in results.items():
+        base = known.get(name, {})
+        if args.update:
+            status = "已寫入基準"
+        elif not base:
+            status = "無基準"
+        else:
+            status = "退步：" + "、".join(regressions[name]) if name in regressions else "通過"
+        print(f"{name:<24}{result['ms']:>10.4f}{base.get('ms', float('nan')):>10.4f}"
+              f"{result['peak_kib']:>11.1f}{base.get('peak_kib', float('nan')):>9.1f}  {status}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
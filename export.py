@@ -0,0 +1,189 @@
+"""唯讀匯出 API：醫院資訊系統 (HIS) 直接取得已送出的問卷，不必再從收件信箱抓附件
+
+用法:
+    python export.py --token <權杖> [--port 8601] [--db data/responses.sqlite3]
+
+    GET /export?since=0&limit=1000                JSON：{"rows": [...], "count": n, "next_cursor": id, "has_more": false}
+    GET /export.csv?since=1234&fields=patient_id,followup,blood_score
+    GET /export?病歷號碼=A123&追蹤期間=海扶術後   (也可用 patient_id= / followup=)
+
+游標就是資料庫編號 id (每列都含)：每晚同步時帶上一次的 next_cursor (CSV 取最後一列的 id)，
+只會讀到之後新增的紀錄。結果由資料庫游標邊讀邊寫出，不會整批放進記憶體。
+請求須帶 Authorization: Bearer <權杖>；預設只監聽本機。
+"""
+import argparse
+import csv
+import hmac
+import io
+import json
+import sys
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+import metrics
+from store import DB_PATH, EXPORT_FIELDS, ResponseStore
+
+DEFAULT_PORT = 8601
+MAX_LIMIT = 100_000
+CHUNK_SIZE = 64 * 1024  # 累積到此大小才寫出一次，避免每列一次系統呼叫
+
+# 篩選參數：欄位名稱或報告上的中文欄名
+FILTERS = {"patient_id": "patient_id", "病歷號碼": "patient_id", "followup": "followup", "追蹤期間": "followup"}
+
+
+class QueryError(ValueError):
+    """查詢參數錯誤 (回應 400)"""
+
+
+# --- 1. 查詢參數 ---
+
+def parse_query(query):
+    """網址查詢字串 -> store.export() 的參數 (limit 另外處理)"""
+    params = {name: values[-1] for name, values in parse_qs(query).items()}
+    try:
+        since = int(params.pop("since", 0))
+        limit = params.pop("limit", None)
+        limit = None if limit is None else int(limit)
+    except ValueError:
+        raise QueryError("since / limit 必須是整數") from None
+    if since < 0:
+        raise QueryError("since 不可為負數")
+    if limit is not None and not 0 < limit <= MAX_LIMIT:
+        raise QueryError(f"limit 須介於 1 ~ {MAX_LIMIT}")
+
+    # id 是游標，一律輸出
+    fields = list(EXPORT_FIELDS)
+    if "fields" in params:
+        requested = [f.strip() for f in params.pop("fields").split(",") if f.strip()]
+        fields = ["id", *dict.fromkeys(f for f in requested if f != "id")]
+        unknown = set(fields) - set(EXPORT_FIELDS)
+        if unknown:
+            raise QueryError(f"不支援的欄位: {', '.join(sorted(unknown))}")
+
+    filters = {}
+    for name, value in params.items():
+        if name not in FILTERS:
+            raise QueryError(f"不支援的參數: {name}")
+        filters[FILTERS[name]] = value
+    return {"after": since, "fields": fields, "limit": limit, **filters}
+
+
+# --- 2. 逐列輸出 ---
+
+def json_chunks(rows, since, limit=None):
+    """rows 最多多讀一列，用來判斷 has_more"""
+    yield '{"rows": ['
+    cursor, count, has_more = since, 0, False
+    for row in rows:
+        if limit is not None and count == limit:
+            has_more = True
+            break
+        yield ("," if count else "") + json.dumps(row, ensure_ascii=False)
+        cursor, count = row["id"], count + 1
+    yield f'], "count": {count}, "next_cursor": {cursor}, "has_more": {json.dumps(has_more)}}}\n'
+
+
+def csv_chunks(rows, fields, limit=None):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    for count, row in enumerate(rows):
+        if limit is not None and count == limit:
+            break
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _buffered(chunks, size=CHUNK_SIZE):
+    pending, length = [], 0
+    for chunk in chunks:
+        pending.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield "".join(pending).encode()
+            pending, length = [], 0
+    if pending:
+        yield "".join(pending).encode()
+
+
+# --- 3. HTTP 端點 ---
+
+def serve(store, port, token, host="127.0.0.1"):
+    """在背景執行緒提供 GET /export (JSON) 與 /export.csv，回傳 server (可呼叫 shutdown())"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    if not token:
+        raise ValueError("匯出 API 必須設定存取權杖")
+    expected = f"Bearer {token}".encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path not in ("/export", "/export.csv"):
+                self.send_error(404)
+                return
+            if not hmac.compare_digest(self.headers.get("Authorization", "").encode(), expected):
+                self.send_error(401)
+                return
+            try:
+                query = parse_query(url.query)
+            except QueryError as e:
+                body = json.dumps({"error": str(e)}, ensure_ascii=False).encode()
+                self.send_response(400)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            as_csv = url.path.endswith(".csv")
+            limit = query.pop("limit")
+            rows = store.export(limit=None if limit is None else limit + 1, **query)
+            if as_csv:
+                chunks = csv_chunks(rows, query["fields"], limit)
+            else:
+                chunks = json_chunks(rows, query["after"], limit)
+
+            # 不送 Content-Length：邊讀邊寫，寫完關閉連線即結束
+            self.send_response(200)
+            self.send_header("Content-Type", "text/csv; charset=utf-8" if as_csv else "application/json; charset=utf-8")
+            self.send_header("Cache-Control", "no-store")
+            self.end_headers()
+            with metrics.span("export", format="csv" if as_csv else "json"):
+                try:
+                    for data in _buffered(chunks):
+                        self.wfile.write(data)
+                finally:
+                    rows.close()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="export", daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="提供已送出問卷的唯讀匯出 API")
+    parser.add_argument("--token", required=True, help="存取權杖 (請求標頭 Authorization: Bearer <權杖>)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--host", default="127.0.0.1", help="監聽位址 (預設只限本機)")
+    parser.add_argument("--db", default=DB_PATH, help="問卷資料庫路徑")
+    args = parser.parse_args(argv)
+
+    server = serve(ResponseStore(args.db), args.port, args.token, host=args.host)
+    print(f"匯出 API: http://{args.host}:{args.port}/export", file=sys.stderr)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,287 @@
+"""歷史報告匯入：把信箱匯出 (mbox / Maildir) 或附件資料夾轉成可持續追加的 Parquet 資料集
+
+用法:
+    python ingest.py export.mbox -o data/history
+    python ingest.py ~/Maildir/hifu -o data/history --workers 8
+    python ingest.py reports/ -o data/history
+
+附件逐封讀取、交給多個程序平行解析，不會把整個信箱載入記憶體。
+每次執行只新增一個 part-*.parquet 檔；已匯入過的問卷 (含重複送出) 會自動略過。
+"""
+import argparse
+import email
+import email.policy
+import glob
+import hashlib
+import io
+import json
+import mailbox
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import questionnaire
+from scoring import SCORE_COLUMNS
+
+REPORT_EXTENSIONS = (".xlsx", ".csv", ".json")
+
+# 報告欄位 -> 資料集欄位 (分數欄位依 questionnaire.INSTRUMENTS)
+HEADER_MAP = {
+    "病歷號碼": "patient_id",
+    "姓名": "name",
+    "出生年月日": "birth",
+    "追蹤期間": "followup",
+    "填寫時間": "submitted_at",
+    **{p.score.report: p.score.column for p in questionnaire.plans()},
+}
+
+# 各量表明細欄位 (依量表順序)；dedup_key 與 Parquet 欄位順序都依此
+DETAIL_FIELDS = tuple(f for p in questionnaire.plans() for f in p.item_columns)
+
+_NUMBER = re.compile(r"\d+")
+
+
+# --- 1. 明細字串解析 ---
+
+def parse_detail(plan, text, score=None):
+    """明細字串 (例如 "Pad:1/0/2, Tam:0/0/0, Clot:1/0"、"[1, 0, 2, 0, 0, 3]") -> {各題欄位: 值}
+
+    數字個數不符時全部為 None。數量題少了最後一題時 (經血明細沒有滲漏次數)，能由總分反推就補上，否則為 None。
+    """
+    fields = plan.item_columns
+    values = [int(v) for v in _NUMBER.findall(str(text or ""))]
+    if plan.kind == questionnaire.COUNT and len(values) == len(fields) - 1:
+        values.append(None)
+        weight = plan.weights[-1]
+        if score is not None and weight:
+            rest = int(score) - sum(v * w for v, w in zip(values, plan.weights[:-1]))
+            if rest >= 0 and rest % weight == 0:
+                values[-1] = rest // weight
+    if len(values) != len(fields):
+        return dict.fromkeys(fields)
+    return dict(zip(fields, values))
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def normalize_row(row, source):
+    """報告中的一列 -> 資料集的一筆紀錄"""
+    record = {field: row.get(header) for header, field in HEADER_MAP.items()}
+    for field in ("patient_id", "name", "birth", "followup", "submitted_at"):
+        record[field] = None if record[field] is None else str(record[field]).strip()
+    for field in SCORE_COLUMNS:
+        record[field] = _to_int(record[field])
+
+    for plan in questionnaire.plans():
+        if plan.detail is not None:
+            record.update(parse_detail(plan, row.get(plan.detail.column), record[plan.score.column]))
+    record["source"] = source
+    record["dedup_key"] = dedup_key(record)
+    return record
+
+
+def dedup_key(record):
+    """同一病患、同一追蹤期間、同一天、答案完全相同 -> 視為重複送出"""
+    answers = [record.get(f) for f in (*DETAIL_FIELDS, *SCORE_COLUMNS)]
+    day = (record.get("submitted_at") or "")[:10]
+    text = json.dumps([record.get("patient_id"), record.get("followup"), day, answers], ensure_ascii=False)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+# --- 2. 附件解析 (在子程序內執行) ---
+
+def _read_rows(filename, data):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".xlsx":
+        from openpyxl import load_workbook
+        wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            rows = wb.worksheets[0].iter_rows(values_only=True)
+            header = [str(h) if h is not None else "" for h in next(rows, [])]
+            return [dict(zip(header, values)) for values in rows if any(v is not None for v in values)]
+        finally:
+            wb.close()
+    if ext == ".csv":
+        import csv
+        return list(csv.DictReader(io.StringIO(data.decode("utf-8-sig"))))
+    if ext == ".json":
+        return json.loads(data.decode("utf-8"))
+    return []
+
+
+def parse_attachment(job):
+    """(來源, 檔名, 內容) -> (紀錄串列, 錯誤訊息)"""
+    source, filename, data = job
+    try:
+        return [normalize_row(row, source) for row in _read_rows(filename, data)], None
+    except Exception as e:
+        return [], f"{source}: {e}"
+
+
+# --- 3. 來源掃描 (逐封產生，不整批載入) ---
+
+def _is_report(filename):
+    return bool(filename) and filename.lower().endswith(REPORT_EXTENSIONS)
+
+
+def _message_attachments(raw, ref):
+    msg = email.message_from_bytes(raw, policy=email.policy.default)
+    ref = msg.get("Message-ID", ref)
+    for part in msg.iter_attachments():
+        filename = part.get_filename()
+        if _is_report(filename):
+            yield f"{ref}/{filename}", filename, part.get_payload(decode=True)
+
+
+def iter_attachments(path):
+    if os.path.isdir(path) and all(os.path.isdir(os.path.join(path, d)) for d in ("cur", "new")):
+        box = mailbox.Maildir(path, factory=None, create=False)
+    elif os.path.isdir(path):
+        for file in sorted(glob.glob(os.path.join(path, "**", "*"), recursive=True)):
+            if _is_report(file) and os.path.isfile(file):
+                with open(file, "rb") as f:
+                    yield file, os.path.basename(file), f.read()
+        return
+    else:
+        box = mailbox.mbox(path, factory=None, create=False)
+
+    try:
+        for key in box.iterkeys():
+            yield from _message_attachments(box.get_bytes(key), str(key))
+    finally:
+        box.close()
+
+
+# --- 4. Parquet 資料集 ---
+
+def _schema():
+    import pyarrow as pa
+
+    plans = questionnaire.plans()
+    fields = [
+        ("patient_id", pa.string()), ("name", pa.string()), ("birth", pa.string()),
+        ("followup", pa.string()), ("submitted_at", pa.string()),
+        # 數量題的分數與明細可能較大，用較寬的整數
+        *[(p.score.column, pa.int32() if p.kind == questionnaire.COUNT else pa.int16()) for p in plans],
+        *[(f, pa.int16() if p.kind == questionnaire.COUNT else pa.int8()) for p in plans for f in p.item_columns],
+        ("source", pa.string()), ("dedup_key", pa.string()),
+    ]
+    return pa.schema(fields)
+
+
+def existing_keys(dataset_dir):
+    """已匯入的 dedup_key (只讀這一欄)"""
+    import pyarrow.parquet as pq
+
+    keys = set()
+    for file in glob.glob(os.path.join(dataset_dir, "part-*.parquet")):
+        keys.update(pq.read_table(file, columns=["dedup_key"]).column(0).to_pylist())
+    return keys
+
+
+class DatasetWriter:
+    """本次匯入寫成一個新的 part 檔，累積到 batch_size 筆寫一個 row group"""
+
+    def __init__(self, dataset_dir, batch_size=20_000):
+        os.makedirs(dataset_dir, exist_ok=True)
+        self.path = os.path.join(dataset_dir, f"part-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.parquet")
+        self.batch_size = batch_size
+        self.schema = _schema()
+        self.rows = []
+        self.written = 0
+        self._writer = None
+
+    def add(self, record):
+        self.rows.append(record)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pylist(self.rows, schema=self.schema)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, self.schema)
+        self._writer.write_table(table)
+        self.written += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+
+
+# --- 5. 主流程 ---
+
+def ingest(source, dataset_dir, workers=None, batch_size=20_000, log=print):
+    seen = existing_keys(dataset_dir)
+    writer = DatasetWriter(dataset_dir, batch_size)
+    stats = {"attachments": 0, "rows": 0, "duplicates": 0, "errors": 0}
+    workers = workers or os.cpu_count() or 1
+    max_pending = workers * 4  # 限制同時在途的附件數量，記憶體用量與信箱大小無關
+
+    def collect(done):
+        for future in done:
+            records, error = future.result()
+            if error:
+                stats["errors"] += 1
+                log(f"⚠️ 解析失敗 {error}")
+            for record in records:
+                stats["rows"] += 1
+                if record["dedup_key"] in seen:
+                    stats["duplicates"] += 1
+                    continue
+                seen.add(record["dedup_key"])
+                writer.add(record)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = set()
+            for job in iter_attachments(source):
+                stats["attachments"] += 1
+                pending.add(pool.submit(parse_attachment, job))
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            done, _ = wait(pending)
+            collect(done)
+    finally:
+        writer.close()
+
+    stats["written"] = writer.written
+    stats["file"] = writer.path if writer.written else None
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="匯入歷史報告附件為 Parquet 資料集")
+    parser.add_argument("source", help="mbox 檔、Maildir 資料夾或附件資料夾")
+    parser.add_argument("-o", "--output", default=os.path.join("data", "history"), help="Parquet 資料集資料夾")
+    parser.add_argument("--workers", type=int, default=None, help="解析用的程序數 (預設為 CPU 數)")
+    parser.add_argument("--batch-size", type=int, default=20_000, help="每個 row group 的筆數")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    stats = ingest(args.source, args.output, args.workers, args.batch_size)
+    print(
+        f"附件 {stats['attachments']} 個、資料 {stats['rows']} 列，"
+        f"新增 {stats['written']} 列、重複略過 {stats['duplicates']} 列、失敗 {stats['errors']} 個，"
+        f"耗時 {time.perf_counter() - start:.1f} 秒"
+    )
+    if stats["file"]:
+        print(f"已寫入 {stats['file']}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,491 @@
+"""多台平板同時填寫的壓力測試
+
+用法:
+    python loadtest.py --sessions 1,5,10,20 [--smtp-latency 300]
+
+在暫存資料夾複製一份 app，寄信改送到本機的假 SMTP 伺服器 (取代 smtp.gmail.com:465)，
+以 `streamlit run` 啟動一個伺服器程序，再讓 N 個模擬的瀏覽器分頁同時經由 websocket 連上，
+各自走完四個步驟並送出，與診間的平板連到同一台主機的情形相同。
+輸出每一步重跑延遲 p50/p95/p99、送出與寄達延遲、伺服器每個 session 的記憶體與錯誤率。
+
+每個模擬分頁各用一個子程序 (只負責收送訊息，不執行 app)，app 只在伺服器程序裡執行，
+所有 session 共用同一個 SQLite、送出暫存區、寄送配額與假 SMTP。
+記憶體以伺服器程序的 RSS 計算：N 個分頁都填完、尚未斷線時的 RSS 減去開始前的 RSS，再除以 N。
+Step 2 / 3 的輸入只重跑所在的 fragment，與瀏覽器相同；定時更新的 fragment (寄送狀態、閒置檢查)
+由瀏覽器的計時器觸發，模擬分頁不會觸發。
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import socket
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+APP_FILES = ("app.py", "blood_chart.png", ".streamlit/config.toml")
+
+
+# --- 1. 假 SMTP 伺服器 ---
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """只實作 smtplib 寄信會用到的指令，收到的信只計數不保存"""
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        try:
+            self.converse()
+        except ConnectionError:
+            pass  # 子程序結束時直接斷線，不算錯誤
+
+    def converse(self):
+        server = self.server
+        self.reply("220 fake-smtp ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.reply("250-fake-smtp")
+                self.reply("250 AUTH PLAIN LOGIN")
+            elif verb == "AUTH":
+                self.reply("235 2.7.0 Accepted")
+            elif verb in ("MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data == b".\r\n":
+                        break
+                    size += len(data)
+                time.sleep(server.latency)
+                with server.lock:
+                    server.messages += 1
+                    server.bytes += size
+                self.reply("250 OK queued")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0):
+        super().__init__(("127.0.0.1", 0), _SMTPHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.bytes = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-smtp", daemon=True).start()
+        return self
+
+
+# --- 2. 測試用的 app 副本與伺服器 ---
+
+def prepare_sandbox(smtp_port, sandbox):
+    """複製 app 到暫存資料夾並寫入指向假 SMTP 的 secrets.toml，不碰正式資料"""
+    for name in os.listdir(ROOT):
+        if name.endswith(".py"):
+            shutil.copy(os.path.join(ROOT, name), sandbox)
+    for name in APP_FILES:
+        target = os.path.join(sandbox, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(os.path.join(ROOT, name)):
+            shutil.copy(os.path.join(ROOT, name), target)
+    with open(os.path.join(sandbox, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+        f.write(
+            'EMAIL_USER = "loadtest@example.com"\n'
+            'EMAIL_PASSWORD = "loadtest"\n'
+            'EMAIL_RECEIVER = "clinic@example.com"\n'
+            'SMTP_HOST = "127.0.0.1"\n'
+            f"SMTP_PORT = {smtp_port}\n"
+            "SMTP_SSL = false\n"
+        )
+    return sandbox
+
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class AppServer:
+    """在 app 副本中以 `streamlit run` 啟動的伺服器程序"""
+
+    def __init__(self, sandbox, timeout=60):
+        self.port = _free_port()
+        self.log_path = os.path.join(sandbox, "server.log")
+        self._log = open(self.log_path, "wb")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "streamlit", "run", "app.py",
+             "--server.port", str(self.port), "--server.address", "127.0.0.1",
+             "--server.headless", "true", "--server.fileWatcherType", "none",
+             "--browser.gatherUsageStats", "false"],
+            cwd=sandbox, stdout=self._log, stderr=subprocess.STDOUT,
+        )
+        self._wait_ready(timeout)
+
+    @property
+    def url(self):
+        return f"ws://127.0.0.1:{self.port}/_stcore/stream"
+
+    def _wait_ready(self, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"streamlit 啟動失敗，請看 {self.log_path}")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/_stcore/health", timeout=1) as r:
+                    if r.status == 200:
+                        return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        raise RuntimeError("streamlit 啟動逾時")
+
+    def rss_kib(self):
+        """伺服器程序目前的 RSS (KiB)；無法讀取時為 None"""
+        try:
+            with open(f"/proc/{self.process.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        try:
+            import psutil
+            return psutil.Process(self.process.pid).memory_info().rss // 1024
+        except Exception:
+            return None
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self._log.close()
+
+
+# --- 3. 模擬一個瀏覽器分頁 ---
+
+class BrowserSession:
+    """經由 websocket 操作 app 的最小前端：記住畫面上的元件，把使用者的操作送回伺服器重跑。
+
+    沒改動的元件不必送：伺服器保留每個元件上一次的值，與瀏覽器只送出變動的效果相同。
+    """
+
+    def __init__(self, url, timeout):
+        from contextlib import ExitStack
+        from websockets.sync.client import connect
+
+        self.timeout = timeout
+        self._stack = ExitStack()
+        self._ws = self._stack.enter_context(
+            connect(url, subprotocols=["streamlit"], max_size=None, open_timeout=timeout))
+        self.elements = {}  # delta 路徑 -> (元件類型, proto, fragment id)
+        self.page_script_hash = ""
+        self.query_string = ""
+
+    def close(self):
+        self._stack.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def run(self, widget=None, state=None):
+        """重跑一次 (帶著剛改動的元件狀態)，等到這次重跑 (含 st.rerun 接著的那次) 結束才回傳"""
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        msg = BackMsg()
+        client_state = msg.rerun_script
+        client_state.query_string = self.query_string
+        client_state.page_script_hash = self.page_script_hash
+        client_state.widget_states.SetInParent()
+        if state is not None:
+            client_state.widget_states.widgets.append(state)
+            fragment_id = widget[2]
+            if fragment_id:
+                # 只重跑所在的 fragment：先移除它上次畫的元件，由這次重跑重新畫
+                client_state.fragment_id = fragment_id
+                self.elements = {p: e for p, e in self.elements.items() if e[2] != fragment_id}
+        self._ws.send(msg.SerializeToString())
+
+        finished = ForwardMsg.ScriptFinishedStatus
+        while True:
+            forward = ForwardMsg()
+            forward.ParseFromString(self._ws.recv(timeout=self.timeout))
+            kind = forward.WhichOneof("type")
+            if kind == "new_session" and not forward.new_session.fragment_ids_this_run:
+                # 整頁重跑：畫面從頭重畫
+                self.elements.clear()
+                self.page_script_hash = forward.new_session.page_script_hash
+            elif kind == "page_info_changed":
+                self.query_string = forward.page_info_changed.query_string
+            elif kind == "delta" and forward.delta.WhichOneof("type") == "new_element":
+                element = forward.delta.new_element
+                element_type = element.WhichOneof("type")
+                self.elements[tuple(forward.metadata.delta_path)] = (
+                    element_type, getattr(element, element_type), forward.delta.fragment_id)
+            elif kind == "script_finished" and forward.script_finished != finished.FINISHED_EARLY_FOR_RERUN:
+                break
+        exceptions = self.of_type("exception")
+        if exceptions:
+            raise RuntimeError(exceptions[0][1].message)
+
+    def of_type(self, element_type):
+        return [e for _, e in sorted(self.elements.items()) if e[0] == element_type]
+
+    def widget(self, element_type, key=None, label=None):
+        for element in self.of_type(element_type):
+            proto = element[1]
+            if key is not None and proto.id.endswith(f"-{key}"):
+                return element
+            if label is not None and label in proto.label:
+                return element
+        raise LookupError(f"找不到元件 {element_type} key={key} label={label}")
+
+    def set_value(self, element_type, key, value):
+        """模擬使用者改動一個元件 (選項類元件為第幾個選項) 並重跑"""
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        widget = self.widget(element_type, key=key)
+        proto = widget[1]
+        state = WidgetState(id=proto.id)
+        if element_type == "text_input":
+            state.string_value = value
+        elif element_type == "number_input":
+            state.double_value = value
+        elif element_type == "radio":
+            state.string_value = proto.options[value]
+        elif element_type == "slider" and proto.options:
+            # st.select_slider：送出選項的顯示文字
+            state.string_array_value.data[:] = [proto.options[value]]
+        elif element_type == "slider":
+            state.double_array_value.data[:] = [value]
+        else:
+            raise TypeError(f"不支援的元件 {element_type}")
+        self.run(widget, state)
+
+    def click(self, label):
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        widget = self.widget("button", label=label)
+        self.run(widget, WidgetState(id=widget[1].id, trigger_value=True))
+
+    def alerts(self, alert_format=None):
+        return [proto.body for _, proto, _ in self.of_type("alert")
+                if alert_format is None or proto.format == alert_format]
+
+
+# --- 4. 模擬一位病患 ---
+
+_SUBMISSION_ID = re.compile(r"編號 #(\d+)")
+
+
+class SessionResult:
+    def __init__(self):
+        self.timings = {}  # step -> [秒]
+        self.submit = None
+        self.delivery = None
+        self.error = None
+
+    def timed(self, step, action, *args):
+        start = time.perf_counter()
+        try:
+            action(*args)
+        except Exception as e:
+            raise RuntimeError(f"{step}: {e}") from e
+        self.timings.setdefault(step, []).append(time.perf_counter() - start)
+
+
+def _wait_delivered(submission_id, timeout):
+    from outbox import Outbox, SENT, FAILED
+
+    outbox = Outbox()
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        info = outbox.status(submission_id)
+        if info and info["status"] == SENT:
+            return info["sent_at"]
+        if info and info["status"] == FAILED:
+            raise RuntimeError(f"delivery: {info['last_error']}")
+        time.sleep(0.05)
+    raise RuntimeError("delivery: timeout")
+
+
+def fill_questionnaire(browser, index, result):
+    from streamlit.proto.Alert_pb2 import Alert
+
+    rng = random.Random(index)
+    result.timed("step1", browser.run)
+    result.timed("step1", browser.set_value, "text_input", "p_id", f"LT{index:05d}")
+    result.timed("step1", browser.set_value, "text_input", "p_name", f"測試{index}")
+    result.timed("step1", browser.click, "下一步")
+
+    for key in ("pl", "pm", "ph"):
+        result.timed("step2", browser.set_value, "number_input", key, rng.randint(0, 6))
+    result.timed("step2", browser.click, "下一步")
+
+    result.timed("step3", browser.set_value, "slider", "pain_slider", rng.randint(0, 10))
+    for i in range(6):
+        result.timed("step3", browser.set_value, "radio", f"radio_udi_{i}", rng.randint(0, 3))
+    result.timed("step3", browser.click, "完成並預覽")
+
+    start = time.perf_counter()
+    submitted = time.time()
+    browser.click("確認送出")
+    result.submit = time.perf_counter() - start
+    errors = browser.alerts(Alert.ERROR)
+    if errors:
+        raise RuntimeError(f"submit: {errors[0]}")
+    ids = [m.group(1) for m in map(_SUBMISSION_ID.search, browser.alerts()) if m]
+    if not ids:
+        raise RuntimeError("submit: 畫面上沒有問卷編號")
+    result.delivery = _wait_delivered(int(ids[0]), browser.timeout) - submitted
+
+
+def run_patient(sandbox, url, index, timeout, ready, results, release):
+    """子程序：一個分頁填完後回報結果，等所有分頁都量完伺服器記憶體才斷線"""
+    os.chdir(sandbox)  # _wait_delivered 讀同一份 data/
+    sys.path.insert(0, sandbox)
+    result = SessionResult()
+    browser = None
+    try:
+        # 先完成 import 與連線，計時只包含填寫過程
+        browser = BrowserSession(url, timeout)
+        ready.wait(timeout)
+        fill_questionnaire(browser, index, result)
+    except Exception as e:
+        result.error = str(e)
+    results.put(result)
+    release.wait(timeout)
+    if browser is not None:
+        browser.close()
+
+
+# --- 5. 統計與報表 ---
+
+def percentiles(values):
+    if not values:
+        return (float("nan"),) * 3
+    if len(values) == 1:
+        return (values[0],) * 3
+    q = statistics.quantiles(values, n=100, method="inclusive")
+    return q[49], q[94], q[98]
+
+
+def run_level(sessions, smtp, server, sandbox, timeout):
+    sent_before = smtp.messages
+    ctx = multiprocessing.get_context("spawn")
+    ready, release = ctx.Barrier(sessions + 1), ctx.Event()
+    results = ctx.Queue()
+    workers = [
+        ctx.Process(target=run_patient, args=(sandbox, server.url, i, timeout, ready, results, release), daemon=True)
+        for i in range(sessions)
+    ]
+    rss_before = server.rss_kib()
+    for worker in workers:
+        worker.start()
+    try:
+        ready.wait(timeout)
+        wall = time.perf_counter()
+        results = [results.get(timeout=timeout * 4) for _ in workers]
+        wall = time.perf_counter() - wall
+        # 所有分頁仍連線中：伺服器上的 session 都還在
+        rss_after = server.rss_kib()
+    finally:
+        release.set()
+        for worker in workers:
+            worker.join(timeout)
+    ok = [r for r in results if r.error is None]
+
+    return {
+        "sessions": sessions,
+        "wall": wall,
+        "steps": {step: percentiles([t for r in results for t in r.timings.get(step, [])])
+                  for step in ("step1", "step2", "step3")},
+        "submit": percentiles([r.submit for r in ok]),
+        "delivery": percentiles([r.delivery for r in ok]),
+        "rss_kib": (rss_after - rss_before) / sessions if None not in (rss_before, rss_after) else float("nan"),
+        "errors": [r.error for r in results if r.error],
+        "delivered": smtp.messages - sent_before,
+        "submitted": len(ok),
+    }
+
+
+def print_report(report):
+    ms = lambda v: f"{v * 1000:7.1f}"
+    print(f"\n=== {report['sessions']} 個同時連線 (總耗時 {report['wall']:.1f} 秒) ===")
+    print(f"{'':10}{'p50 ms':>8}{'p95 ms':>8}{'p99 ms':>8}")
+    for step, (p50, p95, p99) in report["steps"].items():
+        print(f"{step + ' 重跑':10}{ms(p50):>8}{ms(p95):>8}{ms(p99):>8}")
+    for label, key in (("送出", "submit"), ("寄達", "delivery")):
+        p50, p95, p99 = report[key]
+        print(f"{label:10}{ms(p50):>8}{ms(p95):>8}{ms(p99):>8}")
+    error_rate = len(report["errors"]) / report["sessions"] * 100
+    print(f"伺服器 RSS 增加 {report['rss_kib']:.0f} KiB/人")
+    print(f"錯誤率 {error_rate:.1f}%，寄達 {report['delivered']}/{report['submitted']}")
+    for error in report["errors"][:5]:
+        print(f"  ❌ {error}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="多人同時填寫的壓力測試")
+    parser.add_argument("--sessions", default="1,5,10", help="以逗號分隔的同時連線數")
+    parser.add_argument("--smtp-latency", type=float, default=0, help="假 SMTP 每封信的延遲 (毫秒)")
+    parser.add_argument("--timeout", type=float, default=60, help="單次重跑與等待寄達的逾時 (秒)")
+    args = parser.parse_args(argv)
+
+    smtp = FakeSMTPServer(latency=args.smtp_latency / 1000).start()
+    base_dir = tempfile.mkdtemp(prefix="hifu-loadtest-")
+    sandbox = prepare_sandbox(smtp.port, base_dir)
+    server = None
+    try:
+        server = AppServer(sandbox, args.timeout)
+        print(f"假 SMTP: 127.0.0.1:{smtp.port}，測試副本: {sandbox}，streamlit: 127.0.0.1:{server.port}")
+        # 先完整填寫一份讓伺服器載入 app、送出流程與背景工作 (不列入報表)，RSS 只計入之後每個 session 增加的部分
+        run_level(1, smtp, server, sandbox, args.timeout)
+        for level in (int(n) for n in args.sessions.split(",")):
+            print_report(run_level(level, smtp, server, sandbox, args.timeout))
+    finally:
+        if server is not None:
+            server.stop()
+        smtp.shutdown()
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,284 @@
+import smtplib
+import threading
+import time
+from datetime import datetime
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import streamlit as st
+
+import attachments
+import metrics
+import questionnaire
+from outbox import Throttled
+
+
+# --- 1. 設定讀取 ---
+
+TRUE_VALUES = ("1", "true", "yes", "on")
+FALSE_VALUES = ("0", "false", "no", "off")
+
+
+def _parse_bool(value):
+    """TOML 布林值或 "true" / "0" 等字串；bool("false") 會是 True，不能直接轉"""
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise ValueError(f"無法辨識的布林值: {value!r}")
+
+
+def load_mail_config():
+    """讀取 secrets.toml 中的 Email 設定，缺少任何一項時回傳 None
+
+    SMTP_HOST / SMTP_PORT / SMTP_SSL 可省略，預設為 Gmail (smtp.gmail.com:465, SSL)。
+    SMTP_SSL 可寫 true / false 或 "1" / "0"、"yes" / "no"；無法辨識時視同設定錯誤。
+    """
+    try:
+        return {
+            "user": st.secrets["EMAIL_USER"],
+            "password": st.secrets["EMAIL_PASSWORD"],
+            "receiver": st.secrets["EMAIL_RECEIVER"],
+            "host": st.secrets.get("SMTP_HOST", "smtp.gmail.com"),
+            "port": int(st.secrets.get("SMTP_PORT", 465)),
+            "ssl": _parse_bool(st.secrets.get("SMTP_SSL", True)),
+        }
+    except Exception:
+        return None
+
+
+def load_digest_minutes():
+    """彙整寄送的時間窗 (分鐘)，未設定或為 0 表示每份問卷各寄一封"""
+    try:
+        return max(0, int(st.secrets.get("DIGEST_MINUTES", 0)))
+    except Exception:
+        return 0
+
+
+def _secret_int(name, default):
+    try:
+        return max(0, int(st.secrets.get(name, default)))
+    except Exception:
+        return default
+
+
+def load_send_limits():
+    """寄送速度與配額 (Gmail 個人帳號每日約 500 封，預設留一點餘裕)；設為 0 表示不限"""
+    return {
+        "per_minute": _secret_int("SEND_RATE_PER_MINUTE", 20),
+        "burst": _secret_int("SEND_BURST", 5) or 1,
+        "daily_quota": _secret_int("SEND_DAILY_QUOTA", 450),
+    }
+
+
+def load_urgent_thresholds():
+    """經血分數或經痛分數達到門檻時列為緊急，優先寄出"""
+    return _secret_int("URGENT_PBAC", 150), _secret_int("URGENT_VAS", 8)
+
+
+def load_attachment_format():
+    """附件格式 xlsx (預設) / csv / json"""
+    try:
+        fmt = str(st.secrets.get("ATTACHMENT_FORMAT", "xlsx")).lower()
+    except Exception:
+        return "xlsx"
+    return fmt if fmt in attachments.FORMATS else "xlsx"
+
+
+# --- 2. 信件與附件 ---
+
+def summary_html(record, fmt=None):
+    """單份問卷通知信的內文 (record.Response)；fmt 未指定時依 ATTACHMENT_FORMAT 設定"""
+    label = attachments.LABELS[fmt or load_attachment_format()]
+    return f"""
+            <h2 style="color:#00695C;">海扶中心 - 問卷回覆通知</h2>
+            <hr>
+            <p><b>姓名：</b>{record.name}</p>
+            <p><b>病歷號：</b>{record.patient_id}</p>
+            <p><b>追蹤期間：</b>{record.followup}</p>
+            <p><b>總結分數：</b></p>
+            <ul>
+                {"".join(f"<li>{p.score.short}: {record.score(p)}</li>" for p in questionnaire.plans())}
+            </ul>
+            <p>詳細數據請查閱附件 {label}。</p>
+            """
+
+
+def build_message(config, subject, content, attachment, filename, fmt="xlsx"):
+    msg = MIMEMultipart()
+    msg['From'] = config["user"]
+    msg['To'] = config["receiver"]
+    msg['Subject'] = subject
+    msg.attach(MIMEText(content, 'html'))
+
+    # text/csv 也以 base64 附上：保留 utf-8-sig 的 BOM 與 CRLF 換行，Excel 開啟才不會亂碼
+    part = MIMEBase(*attachments.MIME_TYPES[fmt], name=filename)
+    part.set_payload(attachment)
+    encoders.encode_base64(part)
+    part['Content-Disposition'] = f'attachment; filename="{filename}"'
+    msg.attach(part)
+    return msg
+
+
+# --- 3. 共用 SMTP 連線 ---
+
+class SMTPSession:
+    """整個程式共用一條 SMTP 連線，寄送前先檢查連線狀態，失效則重新登入"""
+
+    def __init__(self, idle_timeout=240):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._server = None
+        self._login = None
+        self._last_used = 0.0
+
+    def _close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+        self._server = None
+        self._login = None
+
+    @staticmethod
+    def _identity(config):
+        return (config["host"], config["port"], config["ssl"], config["user"], config["password"])
+
+    def _healthy(self, config):
+        if self._server is None or self._login != self._identity(config):
+            return False
+        # Gmail 約數分鐘後會切斷閒置連線，超過就直接重連，不再多花一次 NOOP
+        if time.monotonic() - self._last_used > self.idle_timeout:
+            return False
+        try:
+            with metrics.span("smtp_noop"):
+                return self._server.noop()[0] == 250
+        except Exception:
+            return False
+
+    def _connect(self, config):
+        self._close()
+        smtp_class = smtplib.SMTP_SSL if config["ssl"] else smtplib.SMTP
+        with metrics.span("smtp_connect"):
+            server = smtp_class(config["host"], config["port"], timeout=30)
+        try:
+            with metrics.span("smtp_login"):
+                server.login(config["user"], config["password"])
+        except Exception:
+            server.close()
+            raise
+        self._server = server
+        self._login = self._identity(config)
+
+    def send(self, config, msg):
+        with self._lock:
+            if not self._healthy(config):
+                self._connect(config)
+            try:
+                with metrics.span("smtp_send"):
+                    self._server.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                # 檢查後才斷線：重連再送一次
+                metrics.count("smtp_reconnects_total")
+                self._connect(config)
+                with metrics.span("smtp_send"):
+                    self._server.send_message(msg)
+            except Exception:
+                self._close()
+                raise
+            self._last_used = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+session = SMTPSession()
+
+# Gmail 超過寄送限制時的回應，例如 "550 5.4.5 Daily user sending limit exceeded"、
+# "421 4.7.0 Try again later"；每日配額用完等一小時再試，其餘等一分鐘
+_THROTTLE_CODES = (421, 450, 451, 452, 454, 550)
+_THROTTLE_WORDS = ("limit", "quota", "rate", "try again later")
+
+
+def throttle_delay(error):
+    """SMTP 錯誤是限流時回傳建議等待秒數，否則回傳 None"""
+    if not isinstance(error, smtplib.SMTPResponseException) or error.smtp_code not in _THROTTLE_CODES:
+        return None
+    message = error.smtp_error
+    if isinstance(message, bytes):
+        message = message.decode(errors="replace")
+    message = str(message).lower()
+    if not any(word in message for word in _THROTTLE_WORDS):
+        return None
+    return 3600 if "daily" in message or "quota" in message else 60
+
+
+def _send(config, msg):
+    try:
+        session.send(config, msg)
+    except smtplib.SMTPResponseException as e:
+        delay = throttle_delay(e)
+        if delay is None:
+            raise
+        raise Throttled(f"{e.smtp_code} {e.smtp_error!r}", delay) from e
+
+
+# --- 4. 寄送 (由背景工作者呼叫，失敗時直接拋出例外交給重試機制) ---
+
+def _require_config():
+    config = load_mail_config()
+    if config is None:
+        raise RuntimeError("設定錯誤：請檢查 secrets.toml 中的 Email 設定")
+    return config
+
+
+def deliver(item):
+    config = _require_config()
+    fmt = load_attachment_format()
+    with metrics.span("attachment", format=fmt):
+        attachment = attachments.build(item["rows"], fmt)
+    filename = attachments.with_extension(item["filename"], fmt)
+    msg = build_message(config, item["subject"], item["content"], attachment, filename, fmt)
+    _send(config, msg)
+
+
+def deliver_digest(items):
+    """將一個時間窗內的多份問卷合併成一封信與一份多列的附件"""
+    config = _require_config()
+    fmt = load_attachment_format()
+    rows = [row for item in items for row in item["rows"]]
+
+    first = datetime.fromtimestamp(items[0]["created_at"])
+    last = datetime.fromtimestamp(items[-1]["created_at"])
+    filename = f"Digest_{first.strftime('%Y%m%d_%H%M')}_Report.{fmt}"
+
+    plans = questionnaire.plans()
+    lines = "".join(
+        f"<tr><td>{r['病歷號碼']}</td><td>{r['姓名']}</td><td>{r['追蹤期間']}</td>"
+        + "".join(f"<td>{r[p.score.report]}</td>" for p in plans) + "</tr>"
+        for r in rows
+    )
+    score_headers = "".join(f"<th>{p.score.short}</th>" for p in plans)
+    content = f"""
+    <h2 style="color:#00695C;">海扶中心 - 問卷彙整通知</h2>
+    <hr>
+    <p><b>期間：</b>{first.strftime('%Y-%m-%d %H:%M')} ~ {last.strftime('%H:%M')}，共 {len(rows)} 份</p>
+    <table border="1" cellpadding="4" style="border-collapse:collapse;">
+        <tr><th>病歷號</th><th>姓名</th><th>追蹤期間</th>{score_headers}</tr>
+        {lines}
+    </table>
+    <p>詳細數據請查閱附件 {attachments.LABELS[fmt]}。</p>
+    """
+
+    with metrics.span("attachment", format=fmt):
+        attachment = attachments.build(rows, fmt)
+    subject = f"【問卷彙整】{len(rows)} 份 - {first.strftime('%Y-%m-%d %H:%M')}"
+    msg = build_message(config, subject, content, attachment, filename, fmt)
+    _send(config, msg)
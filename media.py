@@ -0,0 +1,62 @@
+import hashlib
+import io
+import os
+
+from PIL import Image
+
+# PBAC 參考圖：整個程式只讀一次原始 PNG，預先轉成幾種寬度的 WebP，
+# 寫到 static/ 讓瀏覽器依螢幕大小自行挑選 (srcset)，之後每次重跑都不必再送圖片。
+
+CHART_SOURCE = "blood_chart.png"
+STATIC_DIR = "static"
+STATIC_URL = "./app/static"
+
+# 手機 / 平板 / 桌機；超過原圖寬度的尺寸直接用原圖寬度，不放大
+VARIANT_WIDTHS = (300, 450, 10_000)
+WEBP_QUALITY = 80
+
+
+def encode_variants(source=CHART_SOURCE):
+    """回傳 [(寬度, 檔名, WebP bytes), ...]，寬度由小到大"""
+    with Image.open(source) as img:
+        img.load()
+
+    variants = []
+    for width in sorted({min(w, img.width) for w in VARIANT_WIDTHS}):
+        height = round(img.height * width / img.width)
+        resized = img if width == img.width else img.resize((width, height), Image.LANCZOS)
+        out = io.BytesIO()
+        resized.save(out, format="WEBP", quality=WEBP_QUALITY, method=6)
+        data = out.getvalue()
+        # 檔名帶內容雜湊：圖片更新後網址跟著變，瀏覽器快取不會拿到舊圖
+        digest = hashlib.sha1(data).hexdigest()[:10]
+        name = f"{os.path.splitext(os.path.basename(source))[0]}-{width}.{digest}.webp"
+        variants.append((width, name, data))
+    return variants
+
+
+def publish(variants, static_dir=STATIC_DIR):
+    """寫入 static/；同名檔案內容必定相同，已存在就不重寫，保留舊的 Last-Modified 讓瀏覽器長久快取"""
+    os.makedirs(static_dir, exist_ok=True)
+    for _, name, data in variants:
+        path = os.path.join(static_dir, name)
+        if os.path.exists(path):
+            continue
+        # 多個程序可能同時寫同一個檔：先寫暫存檔再換名，不會被讀到寫一半的檔案
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+def picture_html(variants, caption, alt=""):
+    """以 srcset 交給瀏覽器依實際顯示寬度挑選圖檔"""
+    srcset = ", ".join(f"{STATIC_URL}/{name} {width}w" for width, name, _ in variants)
+    largest = f"{STATIC_URL}/{variants[-1][1]}"
+    return (
+        '<figure style="margin:0;">'
+        f'<img src="{largest}" srcset="{srcset}" sizes="(max-width: 640px) 100vw, 45vw" '
+        f'alt="{alt}" style="width:100%; height:auto;">'
+        f'<figcaption style="text-align:center; color:#78909C; font-size:14px;">{caption}</figcaption>'
+        '</figure>'
+    )
@@ -0,0 +1,159 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# 熱路徑計時與計數：每一步畫面、計分、附件產生、SMTP 各階段。
+# 結果累積在記憶體，由本機 /metrics 以 Prometheus 文字格式提供抓取；
+# 另可開啟追蹤紀錄，每個計時區段寫一行 JSON，依 trace 編號串起同一次請求。
+
+PREFIX = "hifu"
+
+# 秒；涵蓋毫秒級的重跑到數十秒的 SMTP 逾時
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_lock = threading.Lock()
+_histograms = {}  # (span, labels) -> [各組距次數..., 總和, 次數]
+_counters = {}    # (名稱, labels) -> 值
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+_trace_file = None
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+# --- 1. 記錄 ---
+
+def observe(span, seconds, **labels):
+    key = _key(span, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0, 0]
+        hist[bisect.bisect_left(BUCKETS, seconds)] += 1
+        hist[-2] += seconds
+        hist[-1] += 1
+    if _trace_file is not None:
+        _write_trace(span, seconds, labels)
+
+
+@contextmanager
+def span(name, **labels):
+    """計時區段；區段內拋出例外時加上 error 標籤後照常往外拋"""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        # st.rerun() 等流程控制例外不算錯誤
+        if isinstance(e, Exception) and type(e).__module__.split(".")[0] != "streamlit":
+            labels["error"] = type(e).__name__
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def count(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+# --- 2. 追蹤紀錄 ---
+
+def enable_trace(path):
+    """開啟追蹤紀錄 (JSON Lines，附加寫入)"""
+    global _trace_file
+    if _trace_file is None:
+        _trace_file = open(path, "a", encoding="utf-8", buffering=1)
+
+
+@contextmanager
+def trace(trace_id):
+    """區塊內的計時都帶上同一個 trace 編號"""
+    token = _trace_id.set(str(trace_id))
+    try:
+        yield
+    finally:
+        _trace_id.reset(token)
+
+
+def set_trace(trace_id):
+    """目前執行緒之後的計時都帶上這個 trace 編號 (Streamlit 每次重跑開頭呼叫)"""
+    _trace_id.set(str(trace_id))
+
+
+def _write_trace(span_name, seconds, labels):
+    import json
+
+    line = json.dumps({
+        "ts": round(time.time(), 3), "trace": _trace_id.get(), "span": span_name,
+        "ms": round(seconds * 1000, 3), **labels,
+    }, ensure_ascii=False)
+    with _lock:
+        if _trace_file is not None:
+            _trace_file.write(line + "\n")
+
+
+# --- 3. Prometheus 文字格式 ---
+
+def _labels_text(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def render():
+    with _lock:
+        histograms = {k: list(v) for k, v in _histograms.items()}
+        counters = dict(_counters)
+
+    lines = []
+    name = f"{PREFIX}_span_seconds"
+    lines += [f"# HELP {name} 各熱路徑區段耗時", f"# TYPE {name} histogram"]
+    for (span_name, labels), hist in sorted(histograms.items()):
+        labels = (("span", span_name), *labels)
+        cumulative = 0
+        for bound, n in zip((*BUCKETS, "+Inf"), hist):
+            cumulative += n
+            lines.append(f"{name}_bucket{_labels_text(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_sum{_labels_text(labels)} {hist[-2]:.6f}")
+        lines.append(f"{name}_count{_labels_text(labels)} {hist[-1]}")
+
+    for counter in sorted({n for n, _ in counters}):
+        full = f"{PREFIX}_{counter}"
+        lines.append(f"# TYPE {full} counter")
+        for (n, labels), value in sorted(counters.items()):
+            if n == counter:
+                lines.append(f"{full}{_labels_text(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# --- 4. 本機抓取端點 ---
+
+def serve(port, host="127.0.0.1"):
+    """在背景執行緒提供 GET /metrics，回傳 server (可呼叫 shutdown())"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,408 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# 送出的問卷先寫入本機 SQLite，再由背景執行緒寄出，
+# 病患按下送出後不必等待 Gmail。
+# 寄送速度受令牌桶 (每分鐘封數) 與 24 小時配額限制，超過時留在佇列等候，不算失敗；
+# 緊急項目 (priority 較高) 先寄。
+# 同一台主機上的多個 Streamlit 程序可共用同一個暫存區 (data/)：取件、令牌桶與限流暫停都在
+# 資料庫交易內完成，同一封信只會被一個程序取走；同一 submission_key 只排入一次。
+# SQLite WAL 不支援網路磁碟，多台主機不可共用同一個 data/ (見 store.check_local_disk)。
+
+DB_PATH = os.path.join("data", "outbox.sqlite3")
+
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+MAX_ATTEMPTS = 10
+BACKOFF_BASE = 15      # 秒，第一次失敗後的等待時間
+BACKOFF_MAX = 30 * 60  # 秒，退避上限
+POLL_INTERVAL = 30     # 秒，無待寄項目時的巡檢間隔
+LEASE_TIMEOUT = 10 * 60  # 秒，寄送中超過此時間視為該程序已中斷，重新排回佇列
+ERROR_RETRY = 5        # 秒，寄送工作本身出錯 (例如資料庫被鎖住) 後的等待時間，之後加倍
+
+PRIORITY_NORMAL = 0
+PRIORITY_URGENT = 10
+
+QUOTA_WINDOW = 24 * 60 * 60  # 秒，Gmail 的每日配額以滾動 24 小時計算
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    subject TEXT NOT NULL,
+    content TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    rows TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    sent_at REAL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    submission_key TEXT,
+    claimed_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at);
+-- 實際寄出的每一封信 (彙整模式一封信含多份問卷)，用來計算 24 小時配額
+CREATE TABLE IF NOT EXISTS send_log (sent_at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_send_log_time ON send_log (sent_at);
+-- 各程序共用的令牌桶與限流暫停 (只有一列)
+CREATE TABLE IF NOT EXISTS send_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    paused_until REAL NOT NULL DEFAULT 0
+);
+"""
+
+# 取件順序：優先度高的先寄，同優先度依到期時間
+_QUEUE_ORDER = "ORDER BY priority DESC, next_attempt_at, id"
+
+
+class Throttled(Exception):
+    """SMTP 伺服器回報超過寄送限制：不計入失敗次數，retry_after 秒後再試"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _decode(row):
+    item = dict(row)
+    item["rows"] = json.loads(item["rows"])
+    return item
+
+
+def backoff_delay(attempts):
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1))
+
+
+class Outbox:
+    """per_minute / burst：令牌桶速率與可連續寄出的封數；daily_quota：24 小時內最多寄出封數 (0 或 None 不限)。
+
+    令牌桶存在資料庫，共用同一個暫存區的所有程序合計不超過此速率。
+    """
+
+    def __init__(self, path=DB_PATH, per_minute=None, burst=5, daily_quota=None):
+        self.path = path
+        self._wakeup = threading.Event()
+        self.rate = per_minute / 60 if per_minute else None
+        self.burst = max(1, burst)
+        self.daily_quota = daily_quota or None
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        from store import check_local_disk
+        check_local_disk(os.path.dirname(path) or ".")
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+        # 多個程序同時啟動時，欄位補齊由先取得寫入鎖的程序完成
+        with self._connect(immediate=True) as conn:
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(outbox)")}
+            # 舊資料庫沒有優先度 / 冪等鍵 / 取件時間欄位
+            if "priority" not in columns:
+                conn.execute("ALTER TABLE outbox ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+            if "submission_key" not in columns:
+                conn.execute("ALTER TABLE outbox ADD COLUMN submission_key TEXT")
+            if "claimed_at" not in columns:
+                conn.execute("ALTER TABLE outbox ADD COLUMN claimed_at REAL")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_outbox_queue ON outbox (status, priority, next_attempt_at)"
+            )
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_outbox_key ON outbox (submission_key)")
+            conn.execute(
+                "INSERT OR IGNORE INTO send_state (id, tokens, updated_at) VALUES (1, ?, ?)",
+                (self.burst, time.time()),
+            )
+
+    @contextmanager
+    def _connect(self, immediate=False):
+        """immediate：交易一開始就取得寫入鎖 (取件等先讀後寫的交易用，多程序時不會取到同一筆)"""
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                if immediate:
+                    conn.execute("BEGIN IMMEDIATE")
+                yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, subject, content, filename, rows, priority=PRIORITY_NORMAL, submission_key=None):
+        """寫入一筆待寄信件，回傳編號；submission_key 已排入過時不重複寫入，回傳原本的編號"""
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute(
+                "INSERT INTO outbox (created_at, subject, content, filename, rows, next_attempt_at, priority, "
+                "submission_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (submission_key) DO NOTHING",
+                (now, subject, content, filename, json.dumps(rows, ensure_ascii=False), now, priority,
+                 submission_key),
+            )
+            if not cur.rowcount:
+                return conn.execute(
+                    "SELECT id FROM outbox WHERE submission_key = ?", (submission_key,)
+                ).fetchone()[0]
+            item_id = cur.lastrowid
+        self._wakeup.set()
+        return item_id
+
+    def status(self, item_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, status, attempts, next_attempt_at, last_error, sent_at, priority FROM outbox WHERE id = ?",
+                (item_id,),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def _reclaim(self, conn, now):
+        """寄送中超過 LEASE_TIMEOUT 的項目 (該程序已中斷) 重新排回佇列"""
+        conn.execute(
+            "UPDATE outbox SET status = ?, claimed_at = NULL "
+            "WHERE status = ? AND (claimed_at IS NULL OR claimed_at <= ?)",
+            (PENDING, SENDING, now - LEASE_TIMEOUT),
+        )
+
+    def claim_next(self, min_priority=None):
+        """取出一筆到期的待寄信件 (優先度高者優先) 並標記為寄送中，無則回傳 None。
+
+        同時取用一個令牌；寄送速度或配額已滿時也回傳 None。
+        """
+        now = time.time()
+        sql = "SELECT * FROM outbox WHERE status = ? AND next_attempt_at <= ?"
+        args = [PENDING, now]
+        if min_priority is not None:
+            sql += " AND priority >= ?"
+            args.append(min_priority)
+        with self._connect(immediate=True) as conn:
+            self._reclaim(conn, now)
+            if self._send_delay(conn, now) > 0:
+                return None
+            row = conn.execute(f"{sql} {_QUEUE_ORDER} LIMIT 1", args).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE outbox SET status = ?, claimed_at = ? WHERE id = ?", (SENDING, now, row["id"]))
+            self._take_token(conn, now)
+        return _decode(row)
+
+    def claim_batch(self, window):
+        """彙整模式：最舊的待寄信件已等滿 window 秒時，一次取出所有到期信件"""
+        now = time.time()
+        with self._connect(immediate=True) as conn:
+            self._reclaim(conn, now)
+            if self._send_delay(conn, now) > 0:
+                return []
+            rows = conn.execute(
+                "SELECT * FROM outbox WHERE status = ? AND next_attempt_at <= ? ORDER BY created_at, id",
+                (PENDING, now),
+            ).fetchall()
+            if not rows or rows[0]["created_at"] > now - window:
+                return []
+            conn.executemany(
+                "UPDATE outbox SET status = ?, claimed_at = ? WHERE id = ?",
+                [(SENDING, now, row["id"]) for row in rows],
+            )
+            self._take_token(conn, now)
+        return [_decode(row) for row in rows]
+
+    def mark_sent(self, item_ids):
+        """寄出成功 (彙整模式一封信含多個項目)：標記已寄出並記入配額，兩者在同一個交易內完成"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE outbox SET status = ?, sent_at = ?, last_error = NULL WHERE id = ?",
+                [(SENT, now, i) for i in item_ids],
+            )
+            # 令牌在取件時已扣除；配額在寄出後才記錄，多個程序同時寄送時最多超出同時寄送中的封數，
+            # SEND_DAILY_QUOTA 的預設值已留有餘裕
+            conn.execute("INSERT INTO send_log (sent_at) VALUES (?)", (now,))
+            conn.execute("DELETE FROM send_log WHERE sent_at <= ?", (now - QUOTA_WINDOW,))
+
+    def mark_failed(self, item_id, attempts, error):
+        """記錄失敗；未達上限時依指數退避重新排程"""
+        status = FAILED if attempts >= MAX_ATTEMPTS else PENDING
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (status, attempts, time.time() + backoff_delay(attempts), error, item_id),
+            )
+
+    def release(self, item_ids, retry_after):
+        """被伺服器限流的項目放回佇列，不增加失敗次數"""
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE outbox SET status = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                [(PENDING, time.time() + retry_after, "寄送量已達上限，稍後自動重寄", i) for i in item_ids],
+            )
+
+    # --- 寄送速度與配額 ---
+
+    def _recent_sends(self, conn, now):
+        return [row[0] for row in conn.execute(
+            "SELECT sent_at FROM send_log WHERE sent_at > ? ORDER BY sent_at", (now - QUOTA_WINDOW,)
+        )]
+
+    def _tokens(self, conn, now):
+        state = conn.execute("SELECT tokens, updated_at FROM send_state WHERE id = 1").fetchone()
+        return min(self.burst, state["tokens"] + max(0.0, now - state["updated_at"]) * self.rate)
+
+    def _take_token(self, conn, now):
+        if self.rate:
+            conn.execute(
+                "UPDATE send_state SET tokens = ?, updated_at = ? WHERE id = 1", (self._tokens(conn, now) - 1, now)
+            )
+
+    def send_delay(self, n=1):
+        """再寄出 n 封信前需要等待的秒數 (令牌桶、24 小時配額與伺服器限流取最嚴者)"""
+        with self._connect() as conn:
+            return self._send_delay(conn, time.time(), n)
+
+    def _send_delay(self, conn, now, n=1):
+        paused_until = conn.execute("SELECT paused_until FROM send_state WHERE id = 1").fetchone()[0]
+        delay = max(0.0, paused_until - now)
+        if self.rate:
+            delay = max(delay, (n - self._tokens(conn, now)) / self.rate)
+        if self.daily_quota:
+            recent = self._recent_sends(conn, now)
+            over = len(recent) + n - self.daily_quota
+            if over > 0:
+                # 第 over 封舊信滑出 24 小時窗口後才有配額；超過一整天的量以整天估算
+                cycles, index = divmod(over - 1, self.daily_quota)
+                oldest = recent[index] if index < len(recent) else now
+                delay = max(delay, oldest + QUOTA_WINDOW * (cycles + 1) - now)
+        return delay
+
+    def pause(self, seconds):
+        """伺服器限流：所有程序都暫停寄送 seconds 秒"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE send_state SET paused_until = MAX(paused_until, ?) WHERE id = 1", (time.time() + seconds,)
+            )
+
+    def eta(self, item_id, window=0):
+        """待寄項目預計寄出的時間 (epoch 秒)；已寄出或失敗回傳 None"""
+        with self._connect() as conn:
+            item = conn.execute(
+                "SELECT status, created_at, next_attempt_at, priority FROM outbox WHERE id = ?", (item_id,)
+            ).fetchone()
+            if item is None or item["status"] not in (PENDING, SENDING):
+                return None
+            ahead = conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE status = ? AND (priority > ? OR "
+                "(priority = ? AND (next_attempt_at < ? OR (next_attempt_at = ? AND id < ?))))",
+                (PENDING, item["priority"], item["priority"], item["next_attempt_at"],
+                 item["next_attempt_at"], item_id),
+            ).fetchone()[0]
+        due = item["next_attempt_at"]
+        if window and item["priority"] < PRIORITY_URGENT:
+            # 彙整模式：同一時間窗的項目合成一封
+            due, ahead = max(due, item["created_at"] + window), 0
+        return max(due, time.time() + self.send_delay(ahead + 1))
+
+    def seconds_until_due(self, window=0):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT MIN(MAX(next_attempt_at, created_at + CASE WHEN priority >= ? THEN 0 ELSE ? END)) "
+                "FROM outbox WHERE status = ?",
+                (PRIORITY_URGENT, window, PENDING),
+            ).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    def wait(self, timeout):
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+
+class DeliveryWorker(threading.Thread):
+    """背景寄送：依序取出到期信件交給 deliver(item)，失敗則退避重試。
+
+    digest_window 大於 0 時改為彙整模式，每個時間窗的信件一次交給
+    deliver_digest(items) 合併寄出。
+    """
+
+    def __init__(self, outbox, deliver, deliver_digest=None, digest_window=0):
+        super().__init__(name="outbox-delivery", daemon=True)
+        self.outbox = outbox
+        self.deliver = deliver
+        self.deliver_digest = deliver_digest
+        self.digest_window = digest_window if deliver_digest else 0
+
+    def run(self):
+        errors = 0
+        while True:
+            try:
+                self._deliver_next()
+                errors = 0
+            except Exception:
+                # 資料庫暫時無法使用 (例如被鎖住) 等：記錄後稍候再試，執行緒不能因此結束。
+                # 已取出但還沒寄的項目維持寄送中，租約到期後重新排回佇列
+                errors += 1
+                delay = min(ERROR_RETRY * 2 ** (errors - 1), POLL_INTERVAL)
+                log.exception("寄送工作發生錯誤，%s 秒後重試", delay)
+                metrics.count("delivery_errors_total")
+                time.sleep(delay)
+
+    def _deliver_next(self):
+        # 超過寄送速度或配額時先不取件，信件留在佇列 (不算失敗)
+        delay = self.outbox.send_delay()
+        if delay > 0:
+            self.outbox.wait(min(delay, POLL_INTERVAL))
+            return
+
+        # 緊急項目不等彙整時間窗，單獨先寄
+        item = self.outbox.claim_next(min_priority=PRIORITY_URGENT if self.digest_window else None)
+        if item is not None:
+            items = [item]
+            send = lambda batch: self.deliver(batch[0])
+        elif self.digest_window:
+            items = self.outbox.claim_batch(self.digest_window)
+            send = self.deliver_digest
+        else:
+            items = []
+
+        if not items:
+            due = self.outbox.seconds_until_due(self.digest_window)
+            self.outbox.wait(POLL_INTERVAL if due is None else min(due, POLL_INTERVAL))
+            return
+        mode = "digest" if send is self.deliver_digest else "single"
+        try:
+            with metrics.trace(f"outbox-{items[0]['id']}"), metrics.span("delivery", mode=mode):
+                send(items)
+        except Throttled as e:
+            self.outbox.pause(e.retry_after)
+            self.outbox.release([item["id"] for item in items], e.retry_after)
+            metrics.count("deliveries_total", amount=len(items), result="throttled")
+        except Exception as e:
+            for item in items:
+                attempts = item["attempts"] + 1
+                self.outbox.mark_failed(item["id"], attempts, str(e))
+                metrics.count("deliveries_total", result="failed" if attempts >= MAX_ATTEMPTS else "retry")
+        else:
+            self._mark_sent([item["id"] for item in items])
+            metrics.count("deliveries_total", amount=len(items), result="sent")
+
+    def _mark_sent(self, item_ids):
+        """信已寄出：一定要記錄成功，否則租約到期後會再寄一次，資料庫出錯時持續重試"""
+        delay = ERROR_RETRY
+        while True:
+            try:
+                self.outbox.mark_sent(item_ids)
+                return
+            except Exception:
+                log.exception("已寄出但無法記錄 (編號 %s)，%s 秒後重試", item_ids, delay)
+                metrics.count("delivery_errors_total")
+                time.sleep(delay)
+                delay = min(delay * 2, POLL_INTERVAL)
@@ -0,0 +1,149 @@
+import hmac
+
+import pandas as pd
+import streamlit as st
+
+import questionnaire
+from scoring import FOLLOWUP_OPTIONS
+from store import ResponseStore, METRICS
+
+# --- 1. 頁面設定 ---
+st.set_page_config(
+    page_title="海扶治療中心 - 結果分析",
+    page_icon="📊",
+    layout="wide"
+)
+
+METRIC_LABELS = {p.score.column: p.score.title for p in questionnaire.plans()}
+
+@st.cache_resource
+def get_store():
+    return ResponseStore()
+
+@st.cache_resource
+def get_reports():
+    from report import ReportRenderer
+    try:
+        font_path = st.secrets.get("REPORT_FONT")
+    except Exception:
+        font_path = None
+    return ReportRenderer(get_store(), font_path=font_path)
+
+def report_download(patient_id):
+    """報告在背景程序池產生；內容沒變時直接使用已產生的檔案"""
+    try:
+        future = get_reports().request(patient_id)
+    except Exception as e:
+        # 例如找不到中文字型：明確提示，不產生看不懂的報告
+        st.error(f"❌ 無法產生報告：{e}")
+        return
+    if future is None:
+        return
+    if not future.done():
+        report_pending(patient_id)
+        return
+    try:
+        path = future.result()
+        with open(path, "rb") as f:
+            data = f.read()
+    except Exception as e:
+        st.error(f"❌ 報告產生失敗：{e}")
+        return
+    st.download_button("📄 下載歷次追蹤報告 (PDF)", data, file_name=f"{patient_id}_追蹤報告.pdf",
+                       mime="application/pdf")
+
+@st.fragment(run_every=2)
+def report_pending(patient_id):
+    """只在報告產生中才每 2 秒檢查一次；完成後重跑整頁，改由 report_download 顯示下載按鈕 (不再定時)"""
+    future = get_reports().request(patient_id)
+    if future is None or future.done():
+        st.rerun()
+    st.caption("📄 歷次追蹤報告產生中…")
+
+# --- 2. 權限檢查 (僅限醫護人員) ---
+
+def check_password():
+    """secrets.toml 中的 ANALYTICS_PASSWORD；未設定時整頁停用"""
+    try:
+        expected = st.secrets.get("ANALYTICS_PASSWORD")
+    except Exception:
+        expected = None
+    if not expected:
+        st.error("⚠️ 分析頁尚未啟用：請在 secrets.toml 設定 ANALYTICS_PASSWORD")
+        return False
+    if st.session_state.get("analytics_ok"):
+        return True
+
+    password = st.text_input("請輸入醫護人員密碼", type="password")
+    if password:
+        if hmac.compare_digest(password.encode(), str(expected).encode()):
+            st.session_state.analytics_ok = True
+            st.rerun()
+        st.error("❌ 密碼錯誤")
+    return False
+
+st.title("📊 海扶治療中心 - 問卷結果分析")
+
+if not check_password():
+    st.stop()
+
+store = get_store()
+
+def followup_order(values):
+    return [f for f in FOLLOWUP_OPTIONS if f in values] + sorted(set(values) - set(FOLLOWUP_OPTIONS))
+
+# --- 3. 各追蹤期間總覽 (讀取預先累加的彙總表) ---
+
+total = store.count()
+if not total:
+    st.info("目前尚無任何問卷資料。")
+    st.stop()
+st.caption(f"累計 {total} 份問卷")
+
+summary = pd.DataFrame(store.followup_summary())
+
+metric = st.radio("分數項目", list(METRICS), format_func=METRIC_LABELS.get, horizontal=True)
+
+overview = summary[summary["metric"] == metric].set_index("followup")
+overview = overview.reindex(followup_order(overview.index))[["n", "mean", "sd", "min", "max"]]
+overview.columns = ["人次", "平均", "標準差", "最小", "最大"]
+
+col_table, col_chart = st.columns([1, 1.4], gap="large")
+with col_table:
+    st.subheader("各追蹤期間")
+    st.dataframe(overview.style.format({"平均": "{:.1f}", "標準差": "{:.1f}"}), width="stretch")
+with col_chart:
+    st.subheader("平均分數")
+    st.bar_chart(overview["平均"])
+
+# --- 4. 分布與趨勢 ---
+
+st.subheader("分數分布")
+hist = pd.DataFrame(store.histogram(metric))
+if not hist.empty:
+    table = hist.pivot_table(index="bucket", columns="followup", values="n", fill_value=0)
+    table.index.name = "分數" if METRICS[metric] == 1 else f"分數 (每 {METRICS[metric]} 分一組)"
+    st.bar_chart(table[followup_order(table.columns)])
+
+st.subheader("每月平均趨勢")
+daily = pd.DataFrame(store.daily_trend(metric))
+if not daily.empty:
+    daily["month"] = daily["day"].str[:7]
+    monthly = daily.groupby(["month", "followup"])[["n", "total"]].sum()
+    trend = (monthly["total"] / monthly["n"]).unstack("followup")
+    st.line_chart(trend[followup_order(trend.columns)])
+
+# --- 5. 單一病患追蹤 ---
+
+st.subheader("🔎 單一病患歷次結果")
+patient_id = st.text_input("病歷號碼", placeholder="輸入病歷號查詢")
+if patient_id:
+    history = pd.DataFrame(store.for_patient(patient_id.strip()))
+    if history.empty:
+        st.warning("查無此病歷號的紀錄。")
+    else:
+        st.markdown(f"**{history['name'].iloc[-1]}**，共 {len(history)} 份問卷")
+        visits = history.set_index("submitted_at")[["followup", *METRICS]]
+        st.line_chart(visits[list(METRICS)].rename(columns=METRIC_LABELS))
+        st.dataframe(visits.rename(columns={"followup": "追蹤期間", **METRIC_LABELS}), width="stretch")
+        report_download(patient_id.strip())
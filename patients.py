@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from scoring import FOLLOWUP_OPTIONS
+
+# 回診病患查詢：Step 1 輸入病歷號碼後直接帶入姓名、生日與下一個追蹤期間。
+# 最近填寫過的病患常駐記憶體 (LRU)，查詢只是一次 dict 存取；
+# 不在記憶體中的病歷號碼才回頭查資料庫 (patient_id 索引)。
+# 同一台主機上的多個程序共用同一個資料庫時，其他程序新寫入的紀錄依編號遞增補進索引。
+
+DEFAULT_CAPACITY = 50_000
+REFRESH_INTERVAL = 1.0  # 秒，兩次補讀新紀錄的最短間隔
+
+Visit = namedtuple("Visit", "name birth followup submitted_at")
+
+
+def next_followup(followup):
+    """上次的追蹤期間 -> 這次應填的追蹤期間；已是最後一期則維持不變"""
+    if followup not in FOLLOWUP_OPTIONS:
+        return FOLLOWUP_OPTIONS[0]
+    return FOLLOWUP_OPTIONS[min(FOLLOWUP_OPTIONS.index(followup) + 1, len(FOLLOWUP_OPTIONS) - 1)]
+
+
+class PatientIndex:
+    def __init__(self, store, capacity=DEFAULT_CAPACITY):
+        self.store = store
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._visits = OrderedDict()
+        # 先記下目前最大編號再載入：載入期間新寫入的紀錄下次補讀時會再讀到一次 (以較新者為準)
+        self._last_id = store.last_id()
+        self._refreshed = time.monotonic()
+        # 最近的在前；依序插入後再反轉，讓最近的病患排在 LRU 尾端 (最晚被淘汰)
+        for row in reversed(store.latest_visits(limit=capacity)):
+            self._visits[row["patient_id"]] = _visit(row)
+
+    def __len__(self):
+        return len(self._visits)
+
+    def lookup(self, patient_id):
+        """回傳該病患最近一次的 Visit，查無資料回傳 None"""
+        if not patient_id:
+            return None
+        self._refresh()
+        with self._lock:
+            visit = self._visits.get(patient_id)
+            if visit is not None:
+                self._visits.move_to_end(patient_id)
+                return visit
+        row = self.store.latest_visit(patient_id)
+        if row is None:
+            return None
+        visit = _visit(row)
+        self._remember(patient_id, visit)
+        return visit
+
+    def add(self, record, submitted_at):
+        """送出後更新 (record.Response)"""
+        self._remember(record.patient_id, Visit(record.name, record.birth, record.followup, submitted_at))
+
+    def _refresh(self):
+        """補上其他程序寫入的新紀錄"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._refreshed < REFRESH_INTERVAL:
+                return
+            self._refreshed = now
+            after = self._last_id
+        rows = self.store.visits_since(after)
+        for row in rows:
+            self._remember(row["patient_id"], _visit(row))
+        if rows:
+            with self._lock:
+                self._last_id = max(self._last_id, rows[-1]["id"])
+
+    def _remember(self, patient_id, visit):
+        with self._lock:
+            current = self._visits.get(patient_id)
+            if current is not None and current.submitted_at > visit.submitted_at:
+                visit = current
+            self._visits[patient_id] = visit
+            self._visits.move_to_end(patient_id)
+            while len(self._visits) > self.capacity:
+                self._visits.popitem(last=False)
+
+
+def _visit(row):
+    return Visit(row["name"], row["birth"], row["followup"], row["submitted_at"])
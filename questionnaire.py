@@ -0,0 +1,334 @@
+"""問卷量表的宣告式定義 (PBAC / VAS / UDI-6)
+
+題目、選項、權重、Step 4 摘要、通知信與資料庫欄位都由 INSTRUMENTS 產生。
+每個程序第一次用到時由 plans() 驗證並編譯成唯讀的呈現計畫：HTML 片段、選項標籤、
+元件 key 與計分函數都在這時做好，之後每次重跑只依計畫產生元件，不再重建字串或 dict。
+
+新增量表 (例如 UFS-QOL)：在 INSTRUMENTS 加一項即可。record.Response 的欄位與二進位格式、
+批次計分 (scoring)、PDF 報告的趨勢圖 (report) 與歷史報告匯入 (ingest) 都依這份定義產生；
+資料庫欄位在下次啟動時自動補上。
+"""
+import functools
+from collections import namedtuple
+
+# 題型：數量 (分數 = Σ 數量 × 權重)、單一量尺 (分數 = 選擇的值)、多題選項 (分數 = 各題加總)
+COUNT = "count"
+SCALE = "scale"
+CHOICE = "choice"
+
+# 提示訊息的樣式 (對應 st.info / st.success / st.warning)
+STYLES = ("info", "success", "warning")
+
+INSTRUMENTS = (
+    {
+        "key": "pbac",
+        "step": 2,
+        "kind": COUNT,
+        "attribute": "pbac",
+        "max": 100,  # 輸入框上限
+        "none": {"key": "no_blood", "label": "我目前無月經 / 無經血困擾",
+                 "message": "已選擇無經血困擾，分數為 0 分。", "style": "info"},
+        "score": {"column": "blood_score", "icon": "🩸", "label": "經血分數", "short": "經血",
+                  "title": "經血分數 (PBAC)", "report": "經血分數(PBAC)", "bucket": 25,
+                  "color": "#D84315"},
+        "feedback": {"text": "📊 目前計算總分： **{score} 分**", "style": "success"},
+        # 衛生棉 1/5/20、棉條 1/5/10、血塊與滲漏 1/5/5；label 為輸入框的無障礙標籤 (批次模式的前端計分依此找輸入框)
+        "sections": (
+            {"title": "🩸 1. 衛生棉 (使用總片數)", "items": (
+                {"field": "pl", "label": "輕微-片數", "title": "輕微 (1分)", "caption": "僅沾染一點點", "weight": 1},
+                {"field": "pm", "label": "中等-片數", "title": "中等 (5分)", "caption": "沾染約一半", "weight": 5},
+                {"field": "ph", "label": "大量-片數", "title": "大量 (20分)", "caption": "整片全濕", "weight": 20},
+            )},
+            {"title": "🧶 2. 棉條 (使用總支數)", "note": "*若無使用請留白或填 0*", "items": (
+                {"field": "tl", "label": "棉輕-支數", "title": "輕微 (1分)", "caption": "僅一點點", "weight": 1},
+                {"field": "tm", "label": "棉中-支數", "title": "中等 (5分)", "caption": "約一半", "weight": 5},
+                {"field": "th", "label": "棉大-支數", "title": "大量 (10分)", "caption": "整根全濕", "weight": 10},
+            )},
+            {"title": "⚠️ 3. 血塊與滲漏 (發生次數)", "items": (
+                {"field": "cs", "label": "小血塊-次數", "title": "小血塊 (1分)", "caption": "像1元硬幣大小", "weight": 1},
+                {"field": "cl", "label": "大血塊-次數", "title": "大血塊 (5分)", "caption": "大於1元硬幣", "weight": 5},
+                {"field": "ac", "label": "滲漏-次數", "title": "滲漏 (5分)", "caption": "溢出沾到褲子", "weight": 5},
+            )},
+        ),
+        "detail": {"column": "經血明細", "format": "Pad:{0}/{1}/{2}, Tam:{3}/{4}/{5}, Clot:{6}/{7}"},
+    },
+    {
+        "key": "vas",
+        "step": 3,
+        "kind": SCALE,
+        "attribute": "pain_val",
+        "header": {"title": "⚡ 1. 經痛程度", "text": "請依照您<b>「最痛的時候」</b>的感覺，滑動下方拉桿選擇。",
+                   "color": "#C62828", "background": "#FFEBEE", "border": "#E57373"},
+        "none": {"key": "no_pain", "label": "😊 我完全沒有經痛困擾", "message": "已記錄：無經痛。", "style": "success"},
+        "score": {"column": "pain_val", "icon": "⚡", "label": "經痛分數", "short": "經痛",
+                  "title": "經痛分數 (VAS)", "report": "經痛分數(VAS)", "bucket": 1,
+                  "color": "#C62828"},
+        "feedback": {"text": "您選擇的是： **{label}**", "style": "info"},
+        "items": ({"field": "pain_val", "key": "pain_slider", "label": "請左右滑動選擇痛感："},),
+        "options": {
+            0: "0 (無痛) 😊", 1: "1 😐", 2: "2 (輕微) 🙂", 3: "3 😐",
+            4: "4 (中等) 😣", 5: "5 😣", 6: "6 (強烈) 😖", 7: "7 😖",
+            8: "8 (劇烈) 😭", 9: "9 😭", 10: "10 (無法忍受) 🚑",
+        },
+    },
+    {
+        "key": "udi",
+        "step": 3,
+        "kind": CHOICE,
+        "attribute": "udi",
+        "header": {"title": "🚽 2. 排尿與頻尿狀況", "text": "請勾選以下症狀對您生活的<b>「困擾程度」</b>。",
+                   "color": "#1565C0", "background": "#E3F2FD", "border": "#2196F3"},
+        "none": {"key": "no_udi", "label": "🌟 我排尿都很正常，無任何困擾", "message": "已記錄：排尿正常。",
+                 "style": "success"},
+        "score": {"column": "udi_total", "icon": "🚽", "label": "頻尿分數", "short": "頻尿",
+                  "title": "頻尿分數 (UDI-6)", "report": "頻尿分數(UDI)", "bucket": 1,
+                  "color": "#1565C0"},
+        "feedback": {"text": "頻尿困擾總分：{score} 分", "style": "warning", "positive_only": True},
+        "items": (
+            {"field": "udi_0", "icon": "🏃‍♀️", "title": "頻尿", "desc": "覺得小便次數太頻繁？"},
+            {"field": "udi_1", "icon": "🌊", "title": "急迫性漏尿", "desc": "有尿意時來不及跑到廁所就漏出來？"},
+            {"field": "udi_2", "icon": "🤧", "title": "應力性漏尿", "desc": "咳嗽、打噴嚏或運動時會漏尿？"},
+            {"field": "udi_3", "icon": "💧", "title": "滴尿", "desc": "小便量少，滴滴答答解不乾淨？"},
+            {"field": "udi_4", "icon": "😣", "title": "排尿困難", "desc": "小便排不出來，需要用力壓肚子？"},
+            {"field": "udi_5", "icon": "💥", "title": "疼痛", "desc": "下腹部或骨盆會感到疼痛或不舒服？"},
+        ),
+        "options": {0: "完全沒有", 1: "有一點", 2: "滿困擾", 3: "非常嚴重"},
+        "option_format": "{label} ({value})",
+        "detail": {"column": "頻尿明細", "format": "[{0}, {1}, {2}, {3}, {4}, {5}]"},
+    },
+)
+
+
+class SchemaError(ValueError):
+    """量表定義有誤 (程式啟動時即拋出，不會等到病患填寫才出錯)"""
+
+
+NoneOption = namedtuple("NoneOption", "key label message style")
+# bucket：分析頁直方圖的組距；color：報告趨勢圖的顏色
+Score = namedtuple("Score", "column icon label short title report bucket color")
+Feedback = namedtuple("Feedback", "text style positive_only")
+Detail = namedtuple("Detail", "column format")
+# key：元件 key；label：元件標籤 (畫面上隱藏)；html：題目卡片 (CHOICE)；title / caption：數量題的標題與說明 (COUNT)
+Item = namedtuple("Item", "field key label title caption weight html")
+Section = namedtuple("Section", "title_html note items")
+
+
+class Plan(namedtuple("Plan", "key step kind attribute limit none score feedback header_html sections items "
+                              "options option_labels detail weights columns item_columns")):
+    """一個量表編譯後的呈現計畫 (整個程序共用，唯讀)"""
+    __slots__ = ()
+
+    def score_of(self, answers):
+        """answers：各題的值 (順序同 items)"""
+        if self.kind == COUNT:
+            return sum(int(v or 0) * w for v, w in zip(answers, self.weights))
+        if self.kind == SCALE:
+            return int(answers[0] or 0)
+        return sum(int(v or 0) for v in answers)
+
+    def format_option(self, value):
+        return self.option_labels[value]
+
+    def feedback_text(self, score, answers):
+        """即時模式輸入後的提示；不需提示時回傳 None"""
+        if self.feedback.positive_only and score <= 0:
+            return None
+        label = self.option_labels[answers[0]] if self.kind == SCALE else ""
+        return self.feedback.text.format(score=score, label=label)
+
+    def detail_text(self, answers):
+        return self.detail.format.format(*answers)
+
+
+# --- 1. 驗證 ---
+
+_REQUIRED = ("key", "step", "kind", "attribute", "none", "score")
+_NONE_KEYS = ("key", "label", "message", "style")
+_SCORE_KEYS = ("column", "icon", "label", "short", "title", "report")
+
+
+def _require(mapping, keys, where):
+    missing = [k for k in keys if k not in mapping]
+    if missing:
+        raise SchemaError(f"{where} 缺少 {', '.join(missing)}")
+
+
+def _items(instrument):
+    if instrument["kind"] == COUNT:
+        return [item for section in instrument["sections"] for item in section["items"]]
+    return list(instrument["items"])
+
+
+def validate(instruments):
+    """檢查量表定義；有誤時拋出 SchemaError"""
+    seen = {}
+
+    def unique(kind, name, where):
+        if name in seen.setdefault(kind, set()):
+            raise SchemaError(f"{where}：{kind} {name!r} 重複")
+        seen[kind].add(name)
+
+    for instrument in instruments:
+        _require(instrument, _REQUIRED, "量表")
+        where = f"量表 {instrument['key']}"
+        unique("量表", instrument["key"], where)
+        unique("紀錄欄位", instrument["attribute"], where)
+        kind = instrument["kind"]
+        if kind not in (COUNT, SCALE, CHOICE):
+            raise SchemaError(f"{where}：不支援的題型 {kind!r}")
+        if instrument["step"] not in (2, 3):
+            raise SchemaError(f"{where}：step 只能是 2 或 3")
+
+        _require(instrument["none"], _NONE_KEYS, f"{where} 的 none")
+        _require(instrument["score"], _SCORE_KEYS, f"{where} 的 score")
+        for style in (instrument["none"]["style"], instrument.get("feedback", {}).get("style", "info")):
+            if style not in STYLES:
+                raise SchemaError(f"{where}：不支援的樣式 {style!r}")
+        unique("元件 key", instrument["none"]["key"], where)
+        unique("資料庫欄位", instrument["none"]["key"], where)
+        unique("資料庫欄位", instrument["score"]["column"], where)
+        unique("報告欄位", instrument["score"]["report"], where)
+        bucket = instrument["score"].get("bucket", 1)
+        if not isinstance(bucket, int) or bucket <= 0:
+            raise SchemaError(f"{where}：直方圖組距須為正整數")
+
+        _require(instrument, ("sections",) if kind == COUNT else ("items", "options"), where)
+        items = _items(instrument)
+        if not items:
+            raise SchemaError(f"{where}：沒有題目")
+        if kind == SCALE and len(items) != 1:
+            raise SchemaError(f"{where}：量尺題只能有一題")
+        for item in items:
+            _require(item, ("field",), f"{where} 的題目")
+            unique("元件 key", _widget_key(instrument, item), where)
+            if item["field"] != instrument["score"]["column"]:
+                unique("資料庫欄位", item["field"], where)
+            if kind == COUNT:
+                _require(item, ("label", "title", "caption", "weight"), f"{where} 的 {item['field']}")
+                if not isinstance(item["weight"], int) or item["weight"] < 0:
+                    raise SchemaError(f"{where} 的 {item['field']}：權重須為非負整數")
+        if kind == COUNT:
+            if not isinstance(instrument.get("max"), int) or instrument["max"] <= 0:
+                raise SchemaError(f"{where}：max 須為正整數")
+        else:
+            # 選項的值就是分數，也是選項的位置 (st.radio 的 index)
+            if sorted(instrument["options"]) != list(range(len(instrument["options"]))):
+                raise SchemaError(f"{where}：選項的值須為 0 起連續的整數")
+
+        if "detail" in instrument:
+            unique("報告欄位", instrument["detail"]["column"], where)
+            try:
+                instrument["detail"]["format"].format(*range(len(items)))
+            except (IndexError, KeyError, ValueError) as e:
+                raise SchemaError(f"{where}：明細格式有誤 ({e})") from None
+
+
+# --- 2. 編譯 ---
+
+def _widget_key(instrument, item):
+    if "key" in item:
+        return item["key"]
+    return f"radio_{item['field']}" if instrument["kind"] == CHOICE else item["field"]
+
+
+def _header_html(header):
+    return f"""
+    <div style="background-color:{header['background']}; padding:15px; border-radius:10px; border-left:5px solid {header['border']}; margin-bottom:20px;">
+        <h3 style="color:{header['color']}; margin:0;">{header['title']}</h3>
+        <p style="color:#555; margin-top:5px;">{header['text']}</p>
+    </div>
+    """
+
+
+def _compile_item(instrument, item):
+    card = None
+    if instrument["kind"] == CHOICE:
+        card = f"""
+            <div class="udi-card">
+                <div class="udi-title">{item['icon']} {item['title']}</div>
+                <div class="udi-desc">{item['desc']}</div>
+            </div>
+            """
+    return Item(
+        field=item["field"],
+        key=_widget_key(instrument, item),
+        label=item.get("label", item.get("title", item["field"])),
+        title=f"**{item['title']}**" if "title" in item else None,
+        caption=item.get("caption"),
+        weight=item.get("weight"),
+        html=card,
+    )
+
+
+def _compile(instrument):
+    kind = instrument["kind"]
+    sections = ()
+    if kind == COUNT:
+        sections = tuple(
+            Section(
+                title_html=f'<div class="question-title">{section["title"]}</div>',
+                note=section.get("note"),
+                items=tuple(_compile_item(instrument, item) for item in section["items"]),
+            )
+            for section in instrument["sections"]
+        )
+        items = tuple(item for section in sections for item in section.items)
+        options, labels = (), ()
+        limit = instrument["max"]
+    else:
+        items = tuple(_compile_item(instrument, item) for item in instrument["items"])
+        options = tuple(range(len(instrument["options"])))
+        pattern = instrument.get("option_format", "{label}")
+        labels = tuple(pattern.format(label=instrument["options"][v], value=v) for v in options)
+        limit = options[-1]
+
+    none, score = instrument["none"], instrument["score"]
+    feedback = instrument.get("feedback", {})
+    item_columns = tuple(item.field for item in items if item.field != score["column"])
+    return Plan(
+        key=instrument["key"],
+        step=instrument["step"],
+        kind=kind,
+        attribute=instrument["attribute"],
+        limit=limit,
+        none=NoneOption(**{k: none[k] for k in _NONE_KEYS}),
+        score=Score(bucket=score.get("bucket", 1), color=score.get("color", "#00695C"),
+                    **{k: score[k] for k in _SCORE_KEYS}),
+        feedback=Feedback(feedback.get("text", ""), feedback.get("style", "info"),
+                          feedback.get("positive_only", False)),
+        header_html=_header_html(instrument["header"]) if "header" in instrument else None,
+        sections=sections,
+        items=items,
+        options=options,
+        option_labels=labels,
+        detail=Detail(**instrument["detail"]) if "detail" in instrument else None,
+        weights=tuple(item.weight for item in items) if kind == COUNT else None,
+        columns=(none["key"], score["column"], *item_columns),
+        item_columns=item_columns,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def plans():
+    """所有量表的呈現計畫 (每個程序只驗證、編譯一次)"""
+    validate(INSTRUMENTS)
+    return tuple(_compile(instrument) for instrument in INSTRUMENTS)
+
+
+@functools.lru_cache(maxsize=None)
+def _by_key():
+    return {p.key: p for p in plans()}
+
+
+def plan(key):
+    return _by_key()[key]
+
+
+@functools.lru_cache(maxsize=None)
+def for_step(step):
+    return tuple(p for p in plans() if p.step == step)
+
+
+def columns():
+    """資料庫的分數與明細欄位 (依量表順序：無困擾旗標、分數、各題)"""
+    return [column for p in plans() for column in p.columns]
@@ -0,0 +1,168 @@
+import os
+import struct
+from array import array
+
+import questionnaire
+from questionnaire import COUNT, SCALE
+
+# 一份問卷回覆：Step 1-4 直接讀寫同一個物件，不再複製成 dict / 清單 / DataFrame。
+# 各量表的明細放在固定寬度的 array (量尺題為單一整數)，分數由明細即時算出，不另外存。
+# 欄位 (__slots__)、預設值與二進位格式都依 questionnaire.plans() 產生：
+# 量表的 attribute 存明細、none.key 存「無困擾」勾選。
+
+_PLANS = questionnaire.plans()
+
+# 各題型明細的存放型別：數量 uint16，選項與量尺 uint8
+_TYPECODES = {COUNT: "H", questionnaire.CHOICE: "B", SCALE: "B"}
+
+# 二進位格式只用在同一程序內 (session 的 pickle / copy、比對)，不長期保存；
+# 量表定義改變時格式跟著改變，遞增版本讓舊格式明確失敗。
+_VERSION = 3
+# 版本、勾選旗標 (第 i 個量表為第 i 個 bit)、各量表明細 (依量表順序)，其後為字串欄位
+_FLAGS = "B" if len(_PLANS) <= 8 else "H"
+_HEADER = struct.Struct(
+    f"<B{_FLAGS}" + "".join(f"{len(p.items)}{_TYPECODES[p.kind]}" for p in _PLANS)
+)
+_TEXT_LEN = struct.Struct("<H")
+
+KEY_LENGTH = 32  # submission_key：16 bytes 亂數的十六進位字串
+
+
+def new_submission_key():
+    return os.urandom(KEY_LENGTH // 2).hex()
+
+
+def is_submission_key(text):
+    """網址參數帶回的 key 是否為 new_submission_key() 的格式"""
+    return isinstance(text, str) and len(text) == KEY_LENGTH and all(c in "0123456789abcdef" for c in text)
+
+
+class Response:
+    TEXT_FIELDS = ("patient_id", "name", "birth", "followup")
+    # submission_key：Step 1 完成時產生的冪等鍵，重複送出 (重跑、分頁、同一台主機上的其他程序) 只算一份
+    _TEXT = (*TEXT_FIELDS, "submission_key")
+
+    __slots__ = (*_TEXT, *(p.none.key for p in _PLANS), *(p.attribute for p in _PLANS))
+
+    def __init__(self):
+        for field in self._TEXT:
+            setattr(self, field, "")
+        for plan in _PLANS:
+            setattr(self, plan.none.key, False)
+            setattr(self, plan.attribute, 0 if plan.kind == SCALE else array(_TYPECODES[plan.kind], [0] * len(plan.items)))
+
+    def is_empty(self):
+        return self == _EMPTY
+
+    # --- 分數 (勾選「無困擾」時明細在寫入時已歸零，分數自然為 0) ---
+
+    @property
+    def blood_score(self):
+        """經血分數 (緊急門檻用)"""
+        return self.score(questionnaire.plan("pbac"))
+
+    # --- 依量表讀寫 (plan 為 questionnaire.Plan) ---
+
+    def answers(self, plan):
+        """某個量表各題的值 (順序同 plan.items)"""
+        value = getattr(self, plan.attribute)
+        return (value,) if plan.kind == SCALE else value
+
+    def score(self, plan):
+        return plan.score_of(self.answers(plan))
+
+    def set_answers(self, plan, none, values):
+        """寫入某個量表：勾選「無困擾」時各題歸零，其餘限制在 0 ~ 上限"""
+        setattr(self, plan.none.key, bool(none))
+        values = [0 if none else min(max(int(value or 0), 0), plan.limit) for value in values]
+        if plan.kind == SCALE:
+            setattr(self, plan.attribute, values[0])
+        else:
+            target = getattr(self, plan.attribute)
+            for i, value in enumerate(values):
+                target[i] = value
+
+    # --- 輸出 ---
+
+    def values(self):
+        """store.COLUMNS 欄位名稱 -> 值 (不含 submitted_at)"""
+        values = {f: getattr(self, f) for f in self.TEXT_FIELDS}
+        values["submission_key"] = self.submission_key or None
+        for plan in questionnaire.plans():
+            answers = self.answers(plan)
+            values[plan.none.key] = getattr(self, plan.none.key)
+            values[plan.score.column] = plan.score_of(answers)
+            values.update(zip(plan.item_columns, answers))
+        return values
+
+    def report_row(self, submitted_at):
+        """附件報告的一列 (欄位名稱與歷年報告相同，ingest.py 依此解析)"""
+        row = {
+            "病歷號碼": self.patient_id,
+            "姓名": self.name,
+            "出生年月日": self.birth,
+            "追蹤期間": self.followup,
+            "填寫時間": submitted_at,
+        }
+        plans = questionnaire.plans()
+        for plan in plans:
+            row[plan.score.report] = self.score(plan)
+        for plan in plans:
+            if plan.detail is not None:
+                row[plan.detail.column] = plan.detail_text(self.answers(plan))
+        return row
+
+    # --- 二進位格式 ---
+
+    def to_bytes(self):
+        flags = sum(1 << i for i, plan in enumerate(_PLANS) if getattr(self, plan.none.key))
+        values = [value for plan in _PLANS for value in self.answers(plan)]
+        parts = [_HEADER.pack(_VERSION, flags, *values)]
+        for field in self._TEXT:
+            text = getattr(self, field).encode()
+            parts += [_TEXT_LEN.pack(len(text)), text]
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        values = _HEADER.unpack_from(data)
+        if values[0] != _VERSION:
+            raise ValueError(f"不支援的紀錄版本: {values[0]}")
+        record = cls()
+        flags, offset = values[1], 2
+        for i, plan in enumerate(_PLANS):
+            answers = values[offset:offset + len(plan.items)]
+            offset += len(plan.items)
+            setattr(record, plan.none.key, bool(flags & (1 << i)))
+            setattr(record, plan.attribute, answers[0] if plan.kind == SCALE else array(_TYPECODES[plan.kind], answers))
+
+        offset = _HEADER.size
+        for field in cls._TEXT:
+            (length,) = _TEXT_LEN.unpack_from(data, offset)
+            offset += _TEXT_LEN.size
+            setattr(record, field, bytes(data[offset:offset + length]).decode())
+            offset += length
+        return record
+
+    def __reduce__(self):
+        # pickle / copy 一律走精簡的二進位格式
+        return Response.from_bytes, (self.to_bytes(),)
+
+    def __eq__(self, other):
+        return isinstance(other, Response) and self.to_bytes() == other.to_bytes()
+
+    def __repr__(self):
+        scores = ", ".join(f"{plan.key}={self.score(plan)}" for plan in _PLANS)
+        return f"Response({self.patient_id!r}, {self.followup!r}, {scores})"
+
+
+# 量表定義必須放得進上面的格式 (欄位不可重複、明細上限不可超過存放型別、旗標位數足夠)
+if len(set(Response.__slots__)) != len(Response.__slots__):
+    raise questionnaire.SchemaError(f"record.Response 欄位重複: {Response.__slots__}")
+if len(_PLANS) > 16:
+    raise questionnaire.SchemaError("量表超過 16 個，勾選旗標放不下")
+for _plan in _PLANS:
+    if _plan.limit >= 1 << (8 * array(_TYPECODES[_plan.kind]).itemsize):
+        raise questionnaire.SchemaError(f"量表 {_plan.key}：上限 {_plan.limit} 超過明細的存放範圍")
+
+_EMPTY = Response()
@@ -0,0 +1,296 @@
+import glob
+import hashlib
+import io
+import json
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import questionnaire
+
+# 單一病患歷次追蹤報告 (PDF，每個量表一張趨勢圖，依 questionnaire.plans() 產生)。
+# 由 Pillow 繪製後存成 PDF，在獨立的程序池中產生，不佔用 Streamlit 的執行緒。
+# 檔名為「病歷號雜湊_輸入資料雜湊」：病患歷史沒有變動時直接沿用已產生的檔案；
+# 產生新版後同一位病患的舊版立即刪除 (報告含病患資料，不留多餘的副本)。
+
+REPORT_DIR = os.path.join("data", "reports")
+RENDER_VERSION = 2  # 版面改動時遞增，讓舊的快取失效
+
+# 未指定 REPORT_FONT 時依序尋找可顯示中文的字型 (Windows / Linux / macOS)
+FONT_CANDIDATES = (
+    r"C:\Windows\Fonts\msjh.ttc",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/System/Library/Fonts/PingFang.ttc",
+)
+
+PAGE_SIZE = (1240, 1754)  # A4，150 dpi
+DPI = 150
+MARGIN = 90
+TEAL, INK, GREY, GRID = (0, 105, 92), (38, 50, 56), (120, 144, 156), (224, 224, 224)
+
+# 每個量表一張趨勢圖：(分數欄位, 標題, 顏色)
+CHARTS = tuple((p.score.column, p.score.title, p.score.color) for p in questionnaire.plans())
+
+
+class FontNotFound(RuntimeError):
+    """沒有可顯示中文的字型：寧可不產生報告，也不要產生中文全變成方框的報告"""
+
+
+def has_cjk_glyphs(path):
+    """字型是否含中文字形 (缺字時畫出的是 .notdef 方框，與不存在的字元相同)"""
+    from PIL import Image, ImageDraw, ImageFont
+
+    font = ImageFont.truetype(path, 24)
+
+    def draw(text):
+        image = Image.new("L", (80, 40))
+        ImageDraw.Draw(image).text((4, 4), text, font=font, fill=255)
+        return image.tobytes()
+    return draw("海扶") != draw("\uffff\uffff")
+
+
+def find_font(preferred=None):
+    """REPORT_FONT 或第一個找得到的中文字型；都沒有時拋出 FontNotFound"""
+    if preferred:
+        if not os.path.exists(preferred):
+            raise FontNotFound(f"REPORT_FONT 指定的字型不存在: {preferred}")
+        if not has_cjk_glyphs(preferred):
+            raise FontNotFound(f"REPORT_FONT 指定的字型沒有中文字形: {preferred}")
+        return preferred
+    for path in FONT_CANDIDATES:
+        if os.path.exists(path):
+            return path
+    raise FontNotFound("找不到可顯示中文的字型，請安裝 Noto Sans CJK 或在 secrets.toml 設定 REPORT_FONT")
+
+
+# --- 1. 輸入資料與雜湊 ---
+
+def _detail_plans():
+    return [p for p in questionnaire.plans() if p.detail is not None]
+
+
+def history_payload(rows, font_path=None):
+    """store.for_patient() 的紀錄 -> 報告輸入 (只含會出現在報告上的欄位)"""
+    latest = rows[-1]
+    return {
+        "version": RENDER_VERSION,
+        "font": font_path,
+        "patient": {"patient_id": latest["patient_id"], "name": latest["name"], "birth": latest["birth"]},
+        "visits": [
+            {
+                "followup": row["followup"],
+                "submitted_at": row["submitted_at"],
+                **{column: row[column] for column, _, _ in CHARTS},
+                # 有明細的量表：各題的值 (量表 key -> 清單)
+                "details": {p.key: [row[f] for f in p.item_columns] for p in _detail_plans()},
+            }
+            for row in rows
+        ],
+    }
+
+
+def content_hash(payload):
+    text = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+# --- 2. 繪製 (在子程序內執行) ---
+
+def _fonts(font_path):
+    from PIL import ImageFont
+
+    def load(size):
+        return ImageFont.truetype(font_path, size)
+    return {"title": load(44), "heading": load(30), "body": load(24), "small": load(19)}
+
+
+def _draw_chart(draw, box, visits, column, title, color, fonts):
+    left, top, right, bottom = box
+    draw.text((left, top), title, font=fonts["heading"], fill=INK)
+    plot = (left + 60, top + 70, right - 20, bottom - 50)
+    values = [v[column] for v in visits]
+    peak = max(max(values), 1)
+    height = plot[3] - plot[1]
+
+    # 格線與刻度：0 / 一半 / 最高 (最高值留一點空間給數字標籤)
+    for fraction in (0, 0.5, 1):
+        y = plot[3] - height * fraction / 1.1
+        draw.line((plot[0], y, plot[2], y), fill=GRID, width=2)
+        draw.text((plot[0] - 12, y), f"{peak * fraction:g}", font=fonts["small"], fill=GREY, anchor="rm")
+
+    inner = (plot[0] + 40, plot[2] - 40)
+    step = (inner[1] - inner[0]) / max(len(values) - 1, 1)
+    points = [
+        (inner[0] + step * i if len(values) > 1 else sum(inner) / 2, plot[3] - height * value / peak / 1.1)
+        for i, value in enumerate(values)
+    ]
+    # 次數多時標籤只標一部分，避免重疊
+    stride = max(1, -(-len(values) * 120 // (inner[1] - inner[0])))
+    if len(points) > 1:
+        draw.line(points, fill=color, width=4, joint="curve")
+    for i, ((x, y), value, visit) in enumerate(zip(points, values, visits)):
+        draw.ellipse((x - 7, y - 7, x + 7, y + 7), fill=color)
+        if i % stride == 0 or i == len(values) - 1:
+            draw.text((x, y - 14), str(value), font=fonts["small"], fill=color, anchor="md")
+            draw.text((x, plot[3] + 14), visit["followup"], font=fonts["small"], fill=GREY, anchor="ma")
+
+
+def _detail_cell(plan, answers):
+    """明細表的一格：數量題依題組以 / 分隔，其餘以空白分隔"""
+    if plan.sections:
+        values, cells = iter(answers), []
+        for section in plan.sections:
+            cells.append("/".join(str(next(values)) for _ in section.items))
+        return "  ".join(cells)
+    return " ".join(str(v) for v in answers)
+
+
+
+def _new_page():
+    from PIL import Image, ImageDraw
+
+    page = Image.new("RGB", PAGE_SIZE, "white")
+    return page, ImageDraw.Draw(page)
+
+
+def render_pdf(payload):
+    """報告輸入 -> PDF bytes"""
+    fonts = _fonts(payload["font"])
+    patient, visits = payload["patient"], payload["visits"]
+    width = PAGE_SIZE[0]
+
+    page, draw = _new_page()
+    pages = [page]
+    draw.text((MARGIN, MARGIN), "海扶治療中心 - 歷次追蹤報告", font=fonts["title"], fill=TEAL)
+    draw.line((MARGIN, MARGIN + 70, width - MARGIN, MARGIN + 70), fill=TEAL, width=3)
+    info = (f"姓名：{patient['name']}    病歷號：{patient['patient_id']}    "
+            f"出生日期：{patient['birth'] or '-'}    共 {len(visits)} 次填寫")
+    draw.text((MARGIN, MARGIN + 95), info, font=fonts["body"], fill=INK)
+
+    chart_top = MARGIN + 160
+    chart_height = min(470, (PAGE_SIZE[1] - MARGIN - chart_top) // len(CHARTS) - 20)
+    for i, (column, title, color) in enumerate(CHARTS):
+        top = chart_top + i * (chart_height + 20)
+        _draw_chart(draw, (MARGIN, top, width - MARGIN, top + chart_height), visits, column, title, color, fonts)
+
+    # 明細表：每頁放不下時換頁
+    plans, detail_plans = questionnaire.plans(), _detail_plans()
+    headers = ("追蹤期間", "填寫時間", *(p.key.upper() for p in plans), *(p.detail.column for p in detail_plans))
+    # 期間、時間、每個分數固定寬度，明細平分剩下的寬度
+    widths = [150, 240, *[75] * len(plans)]
+    rest = width - 2 * MARGIN - sum(widths)
+    widths += [rest // max(len(detail_plans), 1)] * len(detail_plans)
+    columns = [MARGIN + sum(widths[:i]) for i in range(len(widths))]
+    row_height = 40
+    y = PAGE_SIZE[1]
+    for visit in visits:
+        if y + row_height > PAGE_SIZE[1] - MARGIN:
+            page, draw = _new_page()
+            pages.append(page)
+            draw.text((MARGIN, MARGIN), "歷次填寫明細", font=fonts["heading"], fill=TEAL)
+            y = MARGIN + 60
+            for x, header in zip(columns, headers):
+                draw.text((x, y), header, font=fonts["small"], fill=GREY)
+            y += row_height
+            draw.line((MARGIN, y - 8, width - MARGIN, y - 8), fill=GRID, width=2)
+        cells = (
+            visit["followup"], visit["submitted_at"][:16], *(visit[p.score.column] for p in plans),
+            *(_detail_cell(p, visit["details"][p.key]) for p in detail_plans),
+        )
+        for x, cell in zip(columns, cells):
+            draw.text((x, y), str(cell), font=fonts["small"], fill=INK)
+        y += row_height
+
+    out = io.BytesIO()
+    pages[0].save(out, format="PDF", resolution=DPI, save_all=True, append_images=pages[1:])
+    return out.getvalue()
+
+
+def patient_prefix(patient_id):
+    """報告檔名的病患部分 (不把病歷號直接寫進檔名)"""
+    return hashlib.sha256(patient_id.encode()).hexdigest()[:16]
+
+
+def render_to_file(payload, path):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            # 開始時間取自暫存檔 (與其他報告的修改時間同一個時鐘，比較才準確)
+            started = os.fstat(f.fileno()).st_mtime
+            f.write(render_pdf(payload))
+        os.replace(tmp, path)  # 寫完才出現，讀取端不會拿到半個檔案
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    # 同一位病患在這次開始繪製前就已完成的舊版報告已被取代；
+    # 繪製期間才完成的 (同一位病患同時進行的另一次繪製) 可能正要交給使用者下載，留給下一次再刪
+    prefix = os.path.basename(path).split("_", 1)[0]
+    for old in glob.glob(os.path.join(os.path.dirname(path), f"{prefix}_*.pdf")):
+        if old != path:
+            try:
+                if os.path.getmtime(old) < started:
+                    os.remove(old)
+            except OSError:
+                pass
+    return path
+
+
+# --- 3. 程序池與快取 ---
+
+class ReportRenderer:
+    """依病歷號產生報告；同一份輸入只產生一次，進行中的相同請求共用同一個 Future"""
+
+    def __init__(self, store, report_dir=REPORT_DIR, max_workers=2, font_path=None):
+        self.store = store
+        self.report_dir = report_dir
+        self.max_workers = max_workers
+        self.font_path = find_font(font_path)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pending = {}  # content hash -> Future
+        os.makedirs(report_dir, exist_ok=True)
+        # 舊版的檔名只有內容雜湊，無法對應病患、也不會被取代：一律刪除，需要時重新產生
+        for old in glob.glob(os.path.join(report_dir, "*.pdf")):
+            if "_" not in os.path.basename(old):
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+
+    def _executor(self):
+        if self._pool is None:
+            import multiprocessing
+            # spawn：不複製 Streamlit 程序 (含執行緒) 的狀態
+            self._pool = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def request(self, patient_id):
+        """回傳 Future (結果為 PDF 路徑)；該病患沒有任何紀錄時回傳 None"""
+        rows = self.store.for_patient(patient_id)
+        if not rows:
+            return None
+        payload = history_payload(rows, self.font_path)
+        digest = content_hash(payload)
+        path = os.path.join(self.report_dir, f"{patient_prefix(patient_id)}_{digest}.pdf")
+
+        with self._lock:
+            if digest in self._pending:
+                return self._pending[digest]
+            if os.path.exists(path):
+                future = Future()
+                future.set_result(path)
+                return future
+            future = self._executor().submit(render_to_file, payload, path)
+            self._pending[digest] = future
+        future.add_done_callback(lambda _: self._forget(digest))
+        return future
+
+    def _forget(self, digest):
+        with self._lock:
+            self._pending.pop(digest, None)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,237 @@
+"""評分規則 (questionnaire.INSTRUMENTS) 與批次計分工具
+
+問卷畫面用各量表的 Plan.score_of() 單筆計分；整批資料 (匯出檔、資料庫) 用 score_frame()
+一次向量化計算。numpy / pandas 只在批次函數內才載入，問卷頁面不受影響。
+
+命令列:
+    python scoring.py rescore responses.sqlite3 -o rescored.parquet [--weights pbac=1,5,20,1,5,10,1,5,5]
+    python scoring.py cohort responses.sqlite3 [--path 海扶術前,術後3個月,1年] [-o stats.xlsx]
+"""
+import argparse
+import os
+import sys
+import time
+
+import questionnaire
+
+FOLLOWUP_OPTIONS = ["海扶術前", "海扶術後", "術後3個月", "6個月", "1年", "2年", "3年", "4年以上"]
+
+# 分數欄位與計分方式都來自 questionnaire.INSTRUMENTS (問卷畫面用的是同一份定義)
+SCORE_COLUMNS = tuple(p.score.column for p in questionnaire.plans())
+DEFAULT_PATH = ("海扶術前", "術後3個月", "1年")
+
+
+# --- 1. 批次計分 ---
+
+def score_arrays(answers, weights=None):
+    """answers：量表 key -> 各題的值 (n, 題數)；weights：量表 key -> 權重 (取代定義中的數量題權重)
+
+    回傳 分數欄位 -> 陣列；answers 沒有的量表略過。
+    """
+    import numpy as np
+
+    weights = weights or {}
+    scores = {}
+    for plan in questionnaire.plans():
+        if plan.key not in answers:
+            continue
+        values = np.asarray(answers[plan.key], dtype=np.int64).reshape(-1, len(plan.items))
+        if plan.kind == questionnaire.COUNT:
+            score = values @ np.asarray(weights.get(plan.key, plan.weights), dtype=np.int64)
+        elif plan.kind == questionnaire.SCALE:
+            score = np.clip(values[:, 0], 0, plan.limit)
+        else:
+            score = values.sum(axis=1)
+        scores[plan.score.column] = score
+    return scores
+
+
+def score_frame(df, weights=None):
+    """依明細欄位重新計算各量表分數，回傳新的 DataFrame
+
+    有「無困擾」欄位 (no_blood 等) 時，勾選的病患該項分數一律為 0 (與問卷畫面相同)；
+    缺少明細欄位的量表維持原本的分數。
+    """
+    import numpy as np
+
+    df = df.copy()
+    answers = {}
+    for plan in questionnaire.plans():
+        fields = [item.field for item in plan.items]
+        if not all(field in df for field in fields):
+            continue
+        values = df[fields].fillna(0).to_numpy(dtype=np.int64, copy=True)
+        if plan.none.key in df:
+            values[df[plan.none.key].fillna(False).to_numpy(dtype=bool)] = 0
+        answers[plan.key] = values
+
+    for column, values in score_arrays(answers, weights).items():
+        df[column] = values
+    return df
+
+
+# --- 2. 世代統計 ---
+
+def _ordered_followups(df):
+    seen = set(df["followup"].dropna().unique())
+    return [f for f in FOLLOWUP_OPTIONS if f in seen] + sorted(seen - set(FOLLOWUP_OPTIONS))
+
+
+def cohort_stats(df):
+    """每個追蹤期間的人數與各分數分布 (平均、標準差、中位數、四分位數)"""
+    import pandas as pd
+
+    grouped = df.groupby("followup")[list(SCORE_COLUMNS)]
+    stats = grouped.agg(["count", "mean", "std", "median"])
+    q = grouped.quantile([0.25, 0.75]).unstack()
+    q.columns = [(col, f"p{int(p * 100)}") for col, p in q.columns]
+    stats = pd.concat([stats, q], axis=1).sort_index(axis=1, level=0, sort_remaining=False)
+    return stats.reindex(_ordered_followups(df))
+
+
+def latest_per_visit(df):
+    """同一病患同一追蹤期間重複填寫時，只保留最後一份"""
+    order = ["patient_id", "followup", "submitted_at"] if "submitted_at" in df else ["patient_id", "followup"]
+    return df.sort_values(order).drop_duplicates(["patient_id", "followup"], keep="last")
+
+
+def paired_changes(df, path=DEFAULT_PATH):
+    """同一批病患在 path 相鄰兩期 (及首末兩期) 之間的分數變化"""
+    import pandas as pd
+
+    wide = latest_per_visit(df).pivot(index="patient_id", columns="followup", values=list(SCORE_COLUMNS))
+    pairs = list(zip(path, path[1:]))
+    if len(path) > 2:
+        pairs.append((path[0], path[-1]))
+
+    rows = []
+    for before, after in pairs:
+        for score in SCORE_COLUMNS:
+            if (score, before) not in wide or (score, after) not in wide:
+                continue
+            both = wide[[(score, before), (score, after)]].dropna()
+            delta = both[(score, after)] - both[(score, before)]
+            rows.append({
+                "from": before, "to": after, "score": score, "n": len(delta),
+                "mean_before": both[(score, before)].mean(), "mean_after": both[(score, after)].mean(),
+                "mean_change": delta.mean(), "median_change": delta.median(),
+                "improved_pct": (delta < 0).mean() * 100 if len(delta) else float("nan"),
+            })
+    return pd.DataFrame(rows)
+
+
+# --- 3. 讀寫資料檔 ---
+
+def read_responses(path):
+    """支援 .sqlite3 (store.ResponseStore 資料庫) / .parquet / .csv / .xlsx，或 Parquet 資料夾"""
+    import pandas as pd
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".sqlite3", ".sqlite", ".db"):
+        import sqlite3
+        with sqlite3.connect(path) as conn:
+            return pd.read_sql_query("SELECT * FROM responses", conn)
+    if ext == ".parquet" or os.path.isdir(path):
+        return pd.read_parquet(path)
+    if ext == ".csv":
+        return pd.read_csv(path)
+    if ext in (".xlsx", ".xls"):
+        return pd.read_excel(path)
+    raise ValueError(f"不支援的檔案格式: {path}")
+
+
+def write_frame(df, path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet":
+        df.to_parquet(path, index=False)
+    elif ext == ".csv":
+        df.to_csv(path, index=False, encoding="utf-8-sig")
+    elif ext == ".xlsx":
+        df.to_excel(path, index=False)
+    else:
+        raise ValueError(f"不支援的輸出格式: {path}")
+
+
+# --- 4. 命令列 ---
+
+def _parse_weights(text):
+    """"pbac=1,5,20,..." -> ("pbac", 權重)"""
+    key, _, values = text.partition("=")
+    counts = {p.key: p for p in questionnaire.plans() if p.kind == questionnaire.COUNT}
+    if key not in counts:
+        raise argparse.ArgumentTypeError(f"只有數量題可以指定權重 ({', '.join(counts)})")
+    fields = [item.field for item in counts[key].items]
+    try:
+        weights = tuple(int(w) for w in values.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"權重須為整數: {values}") from None
+    if len(weights) != len(fields):
+        raise argparse.ArgumentTypeError(f"{key} 需要 {len(fields)} 個權重 ({', '.join(fields)})")
+    return key, weights
+
+
+def _rescore(args):
+    df = read_responses(args.input)
+    start = time.perf_counter()
+    rescored = score_frame(df, dict(args.weights or ()))
+    elapsed = time.perf_counter() - start
+
+    changed = {c: int((df[c] != rescored[c]).sum()) for c in SCORE_COLUMNS if c in df}
+    print(f"重新計分 {len(df)} 筆，耗時 {elapsed * 1000:.1f} ms")
+    for column, n in changed.items():
+        print(f"  {column}: {n} 筆分數改變")
+    if args.output:
+        write_frame(rescored, args.output)
+        print(f"已寫入 {args.output}")
+
+
+def _cohort(args):
+    import pandas as pd
+
+    df = read_responses(args.input)
+    if args.rescore:
+        df = score_frame(df)
+    start = time.perf_counter()
+    stats = cohort_stats(df)
+    changes = paired_changes(df, args.path)
+    elapsed = time.perf_counter() - start
+
+    with pd.option_context("display.width", 200, "display.max_columns", None, "display.precision", 2):
+        print(f"共 {len(df)} 筆 / {df['patient_id'].nunique()} 位病患，統計耗時 {elapsed * 1000:.1f} ms\n")
+        print("== 各追蹤期間分數分布 ==")
+        print(stats)
+        print(f"\n== 配對變化 ({' → '.join(args.path)}) ==")
+        print(changes.to_string(index=False) if len(changes) else "(沒有可配對的病患)")
+
+    if args.output:
+        with pd.ExcelWriter(args.output) as writer:
+            stats.to_excel(writer, sheet_name="cohort")
+            changes.to_excel(writer, sheet_name="paired", index=False)
+        print(f"\n已寫入 {args.output}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="問卷批次計分與世代統計")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("rescore", help="依明細欄位重新計算所有分數")
+    p.add_argument("input")
+    p.add_argument("-o", "--output", help="輸出檔 (.parquet / .csv / .xlsx)")
+    p.add_argument("--weights", type=_parse_weights, action="append",
+                   help="數量題的權重，例如 pbac=1,5,20,1,5,10,1,5,5 (依題目順序，可重複指定)")
+    p.set_defaults(func=_rescore)
+
+    p = sub.add_parser("cohort", help="各追蹤期間統計與配對變化")
+    p.add_argument("input")
+    p.add_argument("-o", "--output", help="輸出 Excel 檔")
+    p.add_argument("--path", type=lambda s: tuple(s.split(",")), default=DEFAULT_PATH,
+                   help="配對的追蹤期間順序，以逗號分隔")
+    p.add_argument("--rescore", action="store_true", help="統計前先依明細重新計分")
+    p.set_defaults(func=_cohort)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# 問卷 session 的生命週期：閒置超過時限自動清空並回到 Step 1；
+# 整個程序的 session 數與估計記憶體有上限，超過時清掉最久沒有動作的 session (LRU)。
+# 這裡只記下哪些 session 被清掉；其他 session 的 session_state 由 Streamlit 在各自的執行緒
+# 讀寫，不從這裡跨執行緒去動。被清掉的 session 在自己下一次重跑 (使用者操作或定時的閒置檢查)
+# 時清空全部資料並回到 Step 1；已關閉的分頁則由 Streamlit 在斷線後整個釋放。
+
+DEFAULT_IDLE_TIMEOUT = 10 * 60          # 秒
+DEFAULT_MAX_SESSIONS = 500
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024    # 所有 session 估計大小的總和
+
+_Entry = namedtuple("_Entry", "last_active size")
+
+
+class SessionRegistry:
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, max_sessions=DEFAULT_MAX_SESSIONS,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # session id -> _Entry，最近有動作的在尾端
+        self._evicted = OrderedDict()   # 被清掉、還沒回來重跑的 session id
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def touch(self, session_id, size):
+        """使用者有動作時呼叫：更新最後活動時間與估計大小，並淘汰閒置或超出上限的 session (回傳淘汰數)"""
+        now = time.monotonic()
+        with self._lock:
+            evicted = 0
+            previous = self._sessions.pop(session_id, None)
+            if previous is not None:
+                self._bytes -= previous.size
+                # 定時檢查可能沒跑到 (分頁在背景、裝置休眠)：自己也已閒置逾時就先標記淘汰，再更新時間
+                if now - previous.last_active > self.idle_timeout:
+                    self._evicted[session_id] = True
+                    evicted = 1
+            self._sessions[session_id] = _Entry(now, size)
+            self._bytes += size
+            return evicted + self._collect(now, keep=session_id)
+
+    def sweep(self):
+        """清掉所有閒置逾時的 session (沒有新動作時由定時檢查呼叫)"""
+        with self._lock:
+            return self._collect(time.monotonic())
+
+    def pop_evicted(self, session_id):
+        """此 session 是否已被清掉、該由自己清空資料 (查詢後即清除標記)"""
+        with self._lock:
+            return self._evicted.pop(session_id, False)
+
+    def _collect(self, now, keep=None):
+        """標記要淘汰的 session，回傳數量 (呼叫端持有鎖)"""
+        evicted = 0
+        while self._sessions:
+            session_id, entry = next(iter(self._sessions.items()))
+            over = len(self._sessions) > self.max_sessions or self._bytes > self.max_bytes
+            idle = now - entry.last_active > self.idle_timeout
+            if session_id == keep or not (over or idle):
+                break
+            del self._sessions[session_id]
+            self._bytes -= entry.size
+            self._evicted[session_id] = True
+            evicted += 1
+        # 被清掉後就沒再回來的 session (分頁已關閉) 不必一直記著
+        while len(self._evicted) > self.max_sessions:
+            self._evicted.popitem(last=False)
+        return evicted
+
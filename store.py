@@ -0,0 +1,309 @@
+import logging
+import os
+import sqlite3
+from contextlib import contextmanager
+
+import questionnaire
+
+log = logging.getLogger(__name__)
+
+# 每份送出的問卷完整存一份在本機，依 病歷號碼 / 追蹤期間 / 填寫時間 建索引，
+# 追蹤同一位病患的歷次資料不必再翻信箱。
+# 同一台主機上的多個 Streamlit 程序可同時寫入同一個資料庫 (WAL)；同一 submission_key 只存一份。
+# WAL 依賴同一台機器上的共用記憶體，資料庫不可放在網路磁碟 (NFS / SMB) 給多台主機共用，
+# 多台主機請各自使用本機的 data/ (見 check_local_disk)。
+
+DB_PATH = os.path.join("data", "responses.sqlite3")
+
+# (欄位, SQLite 型別)；名稱與 record.Response.values() 相同
+COLUMNS = [
+    ("patient_id", "TEXT NOT NULL"),
+    ("name", "TEXT NOT NULL"),
+    ("birth", "TEXT"),
+    ("followup", "TEXT NOT NULL"),
+    ("submitted_at", "TEXT NOT NULL"),
+    ("submission_key", "TEXT"),
+    # 各量表的無困擾旗標、分數與各題 (questionnaire.INSTRUMENTS)
+    *[(f, "INTEGER NOT NULL DEFAULT 0") for f in questionnaire.columns()],
+]
+FIELDS = [name for name, _ in COLUMNS]
+# 對外匯出的欄位 (編號即增量同步的游標；submission_key 只在內部去重用)
+EXPORT_FIELDS = ["id", *(f for f in FIELDS if f != "submission_key")]
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS responses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    {", ".join(f"{name} {kind}" for name, kind in COLUMNS)}
+);
+CREATE INDEX IF NOT EXISTS idx_responses_patient ON responses (patient_id, followup, submitted_at);
+CREATE INDEX IF NOT EXISTS idx_responses_followup ON responses (followup, submitted_at);
+
+-- 統計用彙總表：每次 insert 在同一個交易內累加，分析頁不必掃描 responses
+CREATE TABLE IF NOT EXISTS agg_followup (
+    followup TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    total_sq INTEGER NOT NULL,
+    min_value INTEGER NOT NULL,
+    max_value INTEGER NOT NULL,
+    PRIMARY KEY (followup, metric)
+);
+CREATE TABLE IF NOT EXISTS agg_hist (
+    followup TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    PRIMARY KEY (followup, metric, bucket)
+);
+CREATE TABLE IF NOT EXISTS agg_daily (
+    day TEXT NOT NULL,
+    followup TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    PRIMARY KEY (day, followup, metric)
+);
+"""
+
+# 彙總的分數與直方圖組距
+METRICS = {p.score.column: p.score.bucket for p in questionnaire.plans()}
+
+_AGG_UPSERTS = (
+    """INSERT INTO agg_followup (followup, metric, n, total, total_sq, min_value, max_value)
+       VALUES (:followup, :metric, 1, :value, :value * :value, :value, :value)
+       ON CONFLICT (followup, metric) DO UPDATE SET
+           n = n + 1, total = total + excluded.total, total_sq = total_sq + excluded.total_sq,
+           min_value = MIN(min_value, excluded.min_value), max_value = MAX(max_value, excluded.max_value)""",
+    """INSERT INTO agg_hist (followup, metric, bucket, n) VALUES (:followup, :metric, :bucket, 1)
+       ON CONFLICT (followup, metric, bucket) DO UPDATE SET n = n + 1""",
+    """INSERT INTO agg_daily (day, followup, metric, n, total) VALUES (:day, :followup, :metric, 1, :value)
+       ON CONFLICT (day, followup, metric) DO UPDATE SET n = n + 1, total = total + excluded.total""",
+)
+
+_VISIT_COLUMNS = "patient_id, name, birth, followup, submitted_at"
+
+# 已存在相同 submission_key 時不寫入 (key 為 NULL 的舊資料不受影響)
+_INSERT = (
+    f"INSERT INTO responses ({', '.join(FIELDS)}) "
+    f"VALUES ({', '.join('?' for _ in FIELDS)}) "
+    "ON CONFLICT (submission_key) DO NOTHING"
+)
+
+
+# 不支援 SQLite WAL 的網路檔案系統 (/proc/mounts 的類型)
+NETWORK_FILESYSTEMS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afs", "ceph", "glusterfs",
+                       "fuse.sshfs", "fuse.glusterfs", "fuse.s3fs", "davfs"}
+
+
+def check_local_disk(path):
+    """資料庫在網路磁碟上時記錄警告 (WAL、取件租約與冪等鍵只在同一台主機的程序之間成立)；
+    回傳該路徑的檔案系統類型，無法判斷 (非 Linux) 時回傳 None"""
+    try:
+        with open("/proc/mounts", encoding="utf-8") as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return None
+    target = os.path.realpath(path)
+    fs_type, longest = None, -1
+    for mount_point, kind in mounts:
+        inside = target == mount_point or target.startswith(mount_point.rstrip("/") + "/")
+        if inside and len(mount_point) > longest:
+            fs_type, longest = kind, len(mount_point)
+    if fs_type in NETWORK_FILESYSTEMS:
+        log.warning("%s 位於網路磁碟 (%s)：SQLite WAL 只支援同一台主機上的程序共用，"
+                    "多台主機請各自使用本機資料夾", path, fs_type)
+    return fs_type
+
+
+class SubmissionConflict(ValueError):
+    """submission_key 已用於另一位病患的問卷 (例如複製了前一位病患的網址)"""
+
+
+class ResponseStore:
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        check_local_disk(os.path.dirname(path) or ".")
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+        # 欄位補齊與彙總重建要先取得寫入鎖，多個程序同時啟動時只有一個會做
+        with self._connect(immediate=True) as conn:
+            # 後來加的欄位 (submission_key、新增量表的欄位)，舊資料以預設值補上
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(responses)")}
+            for name, kind in COLUMNS:
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE responses ADD COLUMN {name} {kind}")
+            conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_responses_key ON responses (submission_key)"
+            )
+            # 沒有查詢只依填寫時間篩選，舊資料庫的時間索引只會拖慢寫入
+            conn.execute("DROP INDEX IF EXISTS idx_responses_time")
+            # 彙總表是後來加的：舊資料庫第一次開啟時補算一次
+            if conn.execute("SELECT COUNT(*) FROM agg_followup").fetchone()[0] == 0:
+                _rebuild_aggregates(conn)
+
+    @contextmanager
+    def _connect(self, immediate=False):
+        """immediate：交易一開始就取得寫入鎖 (先讀後寫的交易用，避免多程序同時寫入時讀到舊資料)"""
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            with conn:
+                if immediate:
+                    conn.execute("BEGIN IMMEDIATE")
+                yield conn
+        finally:
+            conn.close()
+
+    def insert(self, record, submitted_at):
+        """儲存一份問卷 (record.Response)，回傳 (編號, 是否為新寫入)。
+
+        同一 submission_key 再次送出時不重複寫入，回傳第一次的編號；
+        key 相同但病歷號不同時拋出 SubmissionConflict。
+        (追蹤期間不比對：複製的分頁會把已送出的病患當成回診而帶入下一期)
+        """
+        values = dict(record.values(), submitted_at=submitted_at)
+        with self._connect() as conn:
+            cur = conn.execute(_INSERT, [values[f] for f in FIELDS])
+            if cur.rowcount:
+                _update_aggregates(conn, values)
+                return cur.lastrowid, True
+            row = conn.execute(
+                "SELECT id, patient_id FROM responses WHERE submission_key = ?", (values["submission_key"],)
+            ).fetchone()
+        if row["patient_id"] != values["patient_id"]:
+            raise SubmissionConflict(f"submission_key 已被第 {row['id']} 筆問卷使用")
+        return row["id"], False
+
+    def for_patient(self, patient_id, followup=None):
+        """某位病患的所有紀錄，依填寫時間排序"""
+        sql = "SELECT * FROM responses WHERE patient_id = ?"
+        args = [patient_id]
+        if followup is not None:
+            sql += " AND followup = ?"
+            args.append(followup)
+        sql += " ORDER BY submitted_at, id"
+        with self._connect() as conn:
+            return [dict(row) for row in conn.execute(sql, args)]
+
+    def latest_visit(self, patient_id):
+        """某位病患最近一次填寫的基本資料，查無回傳 None"""
+        with self._connect() as conn:
+            row = conn.execute(
+                f"SELECT {_VISIT_COLUMNS} FROM responses WHERE patient_id = ? "
+                "ORDER BY submitted_at DESC, id DESC LIMIT 1",
+                (patient_id,),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def visits_since(self, after_id):
+        """編號大於 after_id 的紀錄的基本資料 (含編號)，依編號排序；
+        回診索引用來補上其他程序寫入的新紀錄"""
+        with self._connect() as conn:
+            return [dict(row) for row in conn.execute(
+                f"SELECT id, {_VISIT_COLUMNS} FROM responses WHERE id > ? ORDER BY id", (after_id,)
+            )]
+
+    def last_id(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COALESCE(MAX(id), 0) FROM responses").fetchone()[0]
+
+    def latest_visits(self, limit=None):
+        """每位病患最近一次填寫的基本資料，最近填寫的在前"""
+        sql = (
+            f"SELECT {_VISIT_COLUMNS}, MAX(submitted_at) AS last FROM responses "
+            "GROUP BY patient_id ORDER BY last DESC"
+        )
+        args = ()
+        if limit is not None:
+            sql += " LIMIT ?"
+            args = (limit,)
+        with self._connect() as conn:
+            return [dict(row) for row in conn.execute(sql, args)]
+
+    def export(self, after=0, fields=None, patient_id=None, followup=None, limit=None):
+        """逐筆產生編號大於 after 的紀錄 (依編號排序)，供增量同步。
+
+        fields 為 EXPORT_FIELDS 的子集 (預設全部)；資料庫游標邊讀邊產生，不會一次載入記憶體。
+        """
+        fields = list(fields or EXPORT_FIELDS)
+        unknown = set(fields) - set(EXPORT_FIELDS)
+        if unknown:
+            raise ValueError(f"不支援的欄位: {', '.join(sorted(unknown))}")
+        sql = f"SELECT {', '.join(fields)} FROM responses WHERE id > ?"
+        args = [after]
+        if patient_id is not None:
+            sql += " AND patient_id = ?"
+            args.append(patient_id)
+        if followup is not None:
+            sql += " AND followup = ?"
+            args.append(followup)
+        sql += " ORDER BY id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        with self._connect() as conn:
+            for row in conn.execute(sql, args):
+                yield dict(row)
+
+    def count(self):
+        """目前的問卷總份數 (取自彙總表：每份問卷在每個分數各累加一次，任取一個分數加總即可)"""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COALESCE(SUM(n), 0) FROM agg_followup WHERE metric = ?", (next(iter(METRICS)),)
+            ).fetchone()[0]
+
+    # --- 彙總查詢 (分析頁使用) ---
+
+    def followup_summary(self):
+        """各追蹤期間、各分數的人次、平均、標準差、最小、最大值"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM agg_followup").fetchall()
+        summary = []
+        for row in rows:
+            mean = row["total"] / row["n"]
+            var = max(0.0, row["total_sq"] / row["n"] - mean * mean)
+            summary.append({
+                "followup": row["followup"], "metric": row["metric"], "n": row["n"],
+                "mean": mean, "sd": var ** 0.5, "min": row["min_value"], "max": row["max_value"],
+            })
+        return summary
+
+    def histogram(self, metric):
+        with self._connect() as conn:
+            return [dict(row) for row in conn.execute(
+                "SELECT followup, bucket, n FROM agg_hist WHERE metric = ? ORDER BY bucket", (metric,)
+            )]
+
+    def daily_trend(self, metric, since=None):
+        sql = "SELECT day, followup, n, total FROM agg_daily WHERE metric = ?"
+        args = [metric]
+        if since is not None:
+            sql += " AND day >= ?"
+            args.append(since)
+        with self._connect() as conn:
+            return [dict(row) for row in conn.execute(sql + " ORDER BY day", args)]
+
+
+def _update_aggregates(conn, values):
+    day = values["submitted_at"][:10]
+    for metric, width in METRICS.items():
+        value = int(values.get(metric) or 0)
+        params = {
+            "followup": values["followup"], "metric": metric, "value": value,
+            "bucket": value // width * width, "day": day,
+        }
+        for sql in _AGG_UPSERTS:
+            conn.execute(sql, params)
+
+
+def _rebuild_aggregates(conn):
+    for table in ("agg_followup", "agg_hist", "agg_daily"):
+        conn.execute(f"DELETE FROM {table}")
+    columns = ["followup", "submitted_at", *METRICS]
+    for row in conn.execute(f"SELECT {', '.join(columns)} FROM responses"):
+        _update_aggregates(conn, dict(zip(columns, row)))
@@ -0,0 +1,69 @@
+"""兩個程序共用同一個送出暫存區：每封信只被取走一次、只寄出一次
+
+    python -m pytest tests/test_outbox_multiprocess.py
+"""
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import outbox  # noqa: E402
+
+ITEMS = 200
+TIMEOUT = 60
+
+
+def _pending(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT COUNT(*) FROM outbox WHERE status != ?", (outbox.SENT,)).fetchone()[0]
+
+
+def _run_worker(path, log_path, start):
+    """子程序：啟動一個寄送工作者，寄出 = 把編號與程序編號寫進共用的紀錄檔"""
+    box = outbox.Outbox(path)
+    pid = os.getpid()
+
+    def deliver(item):
+        time.sleep(0.002)  # 讓兩個程序的寄送交錯
+        with open(log_path, "a", encoding="utf-8") as f:
+            f.write(f"{item['id']} {pid}\n")
+
+    start.wait()
+    outbox.DeliveryWorker(box, deliver).start()
+    deadline = time.monotonic() + TIMEOUT
+    while _pending(path) and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def test_each_item_sent_once_across_processes(tmp_path):
+    path = str(tmp_path / "outbox.sqlite3")
+    log_path = str(tmp_path / "delivered.log")
+    box = outbox.Outbox(path)
+    ids = [box.enqueue("s", "c", f"{i}.xlsx", [{"n": i}], submission_key=f"key-{i}") for i in range(ITEMS)]
+    # 重複排入不會多一筆
+    assert box.enqueue("s", "c", "0.xlsx", [{"n": 0}], submission_key="key-0") == ids[0]
+
+    context = multiprocessing.get_context("spawn")
+    start = context.Event()
+    workers = [context.Process(target=_run_worker, args=(path, log_path, start)) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    start.set()
+    for worker in workers:
+        worker.join(TIMEOUT + 10)
+        assert worker.exitcode == 0
+
+    with open(log_path, encoding="utf-8") as f:
+        delivered = [line.split() for line in f]
+    sent_ids = sorted(int(item_id) for item_id, _ in delivered)
+    assert sent_ids == sorted(ids)  # 每一筆都寄出，且沒有重複
+    assert all(box.status(i)["status"] == outbox.SENT for i in ids)
+    # 配額紀錄與寄出的封數一致
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM send_log").fetchone()[0] == ITEMS
+    # 兩個程序都有取件
+    assert len({pid for _, pid in delivered}) == 2
@@ -0,0 +1,42 @@
+"""同一位病患同時產生兩份報告時不能互相刪掉；之後的新版才清掉舊版
+
+    python -m pytest tests/test_report_prune.py
+"""
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import report  # noqa: E402
+
+
+def test_overlapping_renders_keep_each_other(tmp_path, monkeypatch):
+    slow_started, fast_done = threading.Event(), threading.Event()
+
+    def render_pdf(payload):
+        if payload == "slow":
+            slow_started.set()
+            fast_done.wait(10)  # 另一份在這份繪製期間完成
+        return payload.encode()
+    monkeypatch.setattr(report, "render_pdf", render_pdf)
+
+    prefix = report.patient_prefix("A1")
+    slow, fast = (str(tmp_path / f"{prefix}_{name}.pdf") for name in ("slow", "fast"))
+    thread = threading.Thread(target=report.render_to_file, args=("slow", slow))
+    thread.start()
+    slow_started.wait(10)
+    report.render_to_file("fast", fast)
+    fast_done.set()
+    thread.join(10)
+    assert os.path.exists(slow) and os.path.exists(fast)
+
+    # 兩份都完成後才開始的新版：同一位病患的舊版都刪掉，其他病患的不動
+    time.sleep(0.05)  # 檔案時間的精度較粗，確定在兩份完成之後才開始
+    other = tmp_path / f"{report.patient_prefix('B2')}_other.pdf"
+    other.write_bytes(b"other")
+    latest = str(tmp_path / f"{prefix}_latest.pdf")
+    report.render_to_file("latest", latest)
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(p) for p in (latest, str(other)))
@@ -0,0 +1,35 @@
+"""session 自己閒置逾時後的第一次操作也要被清掉 (不能只靠定時檢查)
+
+    python -m pytest tests/test_sessions.py
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import sessions  # noqa: E402
+
+
+def test_touch_after_own_idle_timeout_marks_evicted():
+    registry = sessions.SessionRegistry(idle_timeout=0.05)
+    assert registry.touch("a", 100) == 0
+    assert not registry.pop_evicted("a")
+
+    time.sleep(0.1)  # 定時檢查沒有跑 (分頁在背景)
+    assert registry.touch("a", 100) == 1
+    assert registry.pop_evicted("a")
+    assert len(registry) == 1  # 清空後以新的時間繼續登記
+
+    assert registry.touch("a", 100) == 0
+    assert not registry.pop_evicted("a")
+
+
+def test_lru_cap_keeps_the_active_session():
+    registry = sessions.SessionRegistry(max_sessions=2)
+    for session_id in "abc":
+        registry.touch(session_id, 10)
+    assert len(registry) == 2
+    assert registry.pop_evicted("a")
+    assert not registry.pop_evicted("c")